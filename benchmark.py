@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+#(c)2019-2021, karneliuk.com
+
+"""
+This tool benchmarks the parsing, enrichment and rendering hot paths of the toolkit against the recorded fixtures:
+large ifconfig and arp outputs, full IEEE registries, MTR reports with hundreds of hops and long iperf3 tests.
+The enrichment runs against the local mock of the Geo and ISP APIs. The throughput and peak memory are compared
+with the saved baseline and the run fails, if any of them regresses beyond the threshold.
+The fixtures are generated with the fixed seed on the first run; replace them with the real captures, if needed.
+"""
+
+# Modules
+import argparse
+import contextlib
+import copy
+import http.server
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+# The progress bars are not needed, while measuring
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+# Local modules
+import helpers.shared as hs
+import helpers.cache as hc
+import helpers.timeseries as hts
+import get_nodes
+import trace_analyzer
+
+
+# Variables
+fixture_files = {"ifconfig": "ifconfig.txt", "arp": "arp.txt", "oui": "oui.txt", "mam": "mam.txt",
+                 "mtr": "mtr.json", "iperf3": "iperf3.json"}
+
+
+# Classes
+class MockApiHandler(http.server.BaseHTTPRequestHandler):
+    """
+    This class mocks the Geo API (single and bulk lookups) and the ISP API (lookup per ASN)
+    """
+    protocol_version = "HTTP/1.1"
+    calls = 0
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        MockApiHandler.calls += 1
+
+        if url.path == "/isp/net":
+            asn = urllib.parse.parse_qs(url.query).get("asn", ["0"])[0]
+            data = {"data": [{"asn": int(asn), "name": f"ISP {asn}", "description": f"Network of AS{asn}"}]}
+
+        else:
+            ips = url.path.split("/")[-1].split(",")
+            data = [fake_geo(ip) for ip in ips] if len(ips) > 1 else fake_geo(ips[0])
+
+        body = json.dumps(data).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# User-defined functions
+def args_parser():
+    """
+    This function contains information about arguments you provide for the script to run
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of the tools against the recorded fixtures.")
+
+    parser.add_argument("benchmarks", nargs="*",
+                        help=f"Provide the benchmarks to run. By default all of them: {', '.join(benchmarks)}.")
+    parser.add_argument("--fixtures", dest="fixtures", type=str, default="./.bench/fixtures",
+                        help="Provide the directory with the fixtures.")
+    parser.add_argument("--record", action="store_true",
+                        help="Specify if you want to regenerate the fixtures.")
+    parser.add_argument("--runs", dest="runs", type=int, default=5,
+                        help="Provide the amount of runs per benchmark.")
+    parser.add_argument("--baseline", dest="baseline", type=str, default="./.bench_baseline.json",
+                        help="Provide the file with the baseline results.")
+    parser.add_argument("--save", action="store_true",
+                        help="Specify if you want to save the results as the new baseline.")
+    parser.add_argument("--threshold", dest="threshold", type=float, default=20,
+                        help="Provide the allowed regression of the throughput and memory in percent.")
+
+    result = parser.parse_args()
+
+    unknown = [name for name in result.benchmarks if name not in benchmarks]
+    if unknown:
+        sys.exit(f"Unknown benchmarks: {', '.join(unknown)}. Must be {', '.join(benchmarks)}")
+
+    if result.runs < 1:
+        sys.exit("The amount of runs must be at least 1.")
+
+    return result
+
+
+def random_public_ip(rng: random.Random) -> str:
+    """
+    This function returns the random globally routable IPv4 address
+    """
+    while True:
+        ip = ".".join(str(rng.randint(1, 254)) for _ in range(4))
+
+        if hs.is_public_ip(ip):
+            return ip
+
+
+def random_mac(rng: random.Random) -> str:
+    return ":".join(f"{rng.randint(0, 255):x}" for _ in range(6))
+
+
+def fake_geo(ip: str) -> dict:
+    """
+    This function returns the deterministic Geo data for the IP in the format of the Geo API
+    """
+    rng = random.Random(ip)
+
+    return {"ip": ip, "latitude": round(rng.uniform(-60, 70), 4), "longitude": round(rng.uniform(-180, 180), 4),
+            "country_name": f"Country {rng.randint(1, 50)}", "city": f"City {rng.randint(1, 500)}"}
+
+
+def record_fixtures(path: str, seed: int = 42) -> None:
+    """
+    This function generates the fixtures in the formats of the real tools and registries
+    """
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+
+    # ifconfig (Linux) with 2000 interfaces
+    with open(os.path.join(path, fixture_files["ifconfig"]), "w") as f:
+        for i in range(2000):
+            f.write(f"eth{i}: flags=4163<UP,BROADCAST,RUNNING,MULTICAST>  mtu 1500\n"
+                    f"        inet 10.{i // 256}.{i % 256}.1  netmask 255.255.255.0  broadcast 10.{i // 256}.{i % 256}.255\n"
+                    f"        inet6 2001:db8:{i:x}::1  prefixlen 64  scopeid 0x0<global>\n"
+                    f"        inet6 fe80::{i:x}  prefixlen 64  scopeid 0x20<link>\n"
+                    f"        ether {random_mac(rng)}  txqueuelen 1000  (Ethernet)\n\n")
+
+    # arp -an (Linux) with 50000 entries, 5% of them incomplete
+    with open(os.path.join(path, fixture_files["arp"]), "w") as f:
+        for i in range(50000):
+            ip = f"10.{i // 65536}.{i // 256 % 256}.{i % 256}"
+            f.write(f"? ({ip}) at <incomplete> on eth{i % 8}\n" if rng.random() < 0.05 else
+                    f"? ({ip}) at {random_mac(rng)} [ether] on eth{i % 8}\n")
+
+    # IEEE MA-L (the size of the real registry) and MA-M
+    with open(os.path.join(path, fixture_files["oui"]), "w") as f:
+        f.write("OUI/MA-L\t\t\tOrganization\ncompany_id\t\t\tOrganization\n\t\t\t\tAddress\n\n")
+
+        for oui in sorted(rng.sample(range(1 << 24), 35000)):
+            vendor = f"Vendor {oui:06X} Inc."
+            f.write(f"{oui >> 16:02X}-{oui >> 8 & 255:02X}-{oui & 255:02X}   (hex)\t\t{vendor}\n"
+                    f"{oui:06X}     (base 16)\t\t{vendor}\n\t\t\t\t1 Main Street\n\t\t\t\tCity  ST  00000\n\t\t\t\tUS\n\n")
+
+    with open(os.path.join(path, fixture_files["mam"]), "w") as f:
+        f.write("OUI/MA-M\t\t\tOrganization\ncompany_id\t\t\tOrganization\n\t\t\t\tAddress\n\n")
+
+        for oui in sorted(rng.sample(range(1 << 24), 4000)):
+            block = rng.randint(0, 15)
+            vendor = f"Vendor {oui:06X}{block:X} Ltd."
+            f.write(f"{oui >> 16:02X}-{oui >> 8 & 255:02X}-{oui & 255:02X}   (hex)\t\t{vendor}\n"
+                    f"{block:X}00000-{block:X}FFFFF     (base 16)\t\t{vendor}\n\t\t\t\t1 Main Street\n\t\t\t\tUS\n\n")
+
+    # MTR report with 500 hops over 200 unique IPs in 40 ASNs
+    ips = [random_public_ip(rng) for _ in range(200)]
+    asns = {ip: f"AS{rng.choice(range(64500, 64540))}" for ip in ips}
+    hubs = []
+
+    for i in range(500):
+        ip = rng.choice(ips) if rng.random() > 0.05 else "???"
+        avg = round(rng.uniform(1, 200), 2)
+        hubs.append({"count": i + 1, "host": ip, "ASN": asns.get(ip, "AS???"), "Loss%": rng.choice([0.0] * 9 + [10.0]),
+                     "Snt": 10, "Last": avg, "Avg": avg, "Best": avg, "Wrst": avg, "StDev": 0.0})
+
+    with open(os.path.join(path, fixture_files["mtr"]), "w") as f:
+        json.dump({"report": {"mtr": {"src": "bench", "dst": "example.com", "tests": 10}, "hubs": hubs}}, f)
+
+    # iperf3 with 8 streams over 1 hour
+    intervals = []
+    for i in range(3600):
+        streams = [{"socket": s, "start": i, "end": i + 1, "bits_per_second": rng.uniform(1e7, 1e8),
+                    "retransmits": rng.randint(0, 3), "rtt": rng.randint(1000, 50000)} for s in range(8)]
+        intervals.append({"streams": streams, "sum": {"start": i, "end": i + 1, "bits_per_second": sum(s["bits_per_second"] for s in streams),
+                                                      "retransmits": sum(s["retransmits"] for s in streams)}})
+
+    with open(os.path.join(path, fixture_files["iperf3"]), "w") as f:
+        json.dump({"start": {"timestamp": {"timesecs": 1620000000}, "connecting_to": {"host": "192.0.2.1", "port": 5201}},
+                   "intervals": intervals,
+                   "end": {"sum_sent": {"bits_per_second": 4e8, "retransmits": 100}, "sum_received": {"bits_per_second": 4e8},
+                           "streams": [{"sender": {"mean_rtt": 20000}} for _ in range(8)]}}, f)
+
+
+def load_fixture(path: str, name: str):
+    with open(os.path.join(path, fixture_files[name]), "r") as f:
+        return json.load(f) if fixture_files[name].endswith(".json") else f.read()
+
+
+def start_mock_api() -> str:
+    """
+    This function starts the mock API in the background and returns its URL
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MockApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def get_geo_config(api: str, workdir: str, bulk: bool = False) -> dict:
+    """
+    This function returns the trace_analyzer configuration pointing to the mock API and the scratch directory
+    """
+    return {"geo": {"url": f"{api}/geo", "token": "bench", "bulk": bulk, "workers": 10},
+            "isp": {"url": f"{api}/isp", "workers": 10},
+            "paths": {"cache": workdir},
+            "result": {"file_map": os.path.join(workdir, "map.html"), "file_asn": os.path.join(workdir, "isp.html"),
+                       "max_nodes": 1000}}
+
+
+def bench_ifconfig(fixtures: str, context: dict):
+    raw = load_fixture(fixtures, "ifconfig")
+
+    return lambda: len(get_nodes.parse_ifconfig(raw, "Linux"))
+
+
+def bench_arp(fixtures: str, context: dict):
+    raw = load_fixture(fixtures, "arp")
+
+    return lambda: len(get_nodes.parse_arp(raw, "Linux"))
+
+
+def bench_oui_parse(fixtures: str, context: dict):
+    registries = [load_fixture(fixtures, "oui"), load_fixture(fixtures, "mam")]
+
+    def run():
+        index = {24: {}, 28: {}, 36: {}}
+
+        for macs in registries:
+            get_nodes.parse_oui_db(macs=macs, index=index)
+
+        return sum(len(v) for v in index.values())
+
+    return run
+
+
+def bench_find_vendor(fixtures: str, context: dict):
+    index = {24: {}, 28: {}, 36: {}}
+
+    for name in ["oui", "mam"]:
+        get_nodes.parse_oui_db(macs=load_fixture(fixtures, name), index=index)
+
+    neighbors = get_nodes.parse_arp(load_fixture(fixtures, "arp"), "Linux")
+
+    return lambda: len(get_nodes.find_vendor(index, copy.deepcopy(neighbors)))
+
+
+def bench_geo(fixtures: str, context: dict, bulk: bool = False):
+    mtr = load_fixture(fixtures, "mtr")
+    geo_config = get_geo_config(context["api"], context["workdir"], bulk=bulk)
+
+    # Each run starts with the empty cache to hit the API
+    def run():
+        cache = hc.DiskCache(path=os.path.join(context["workdir"], f"geo_{time.perf_counter_ns()}.json"))
+        trace_analyzer.augment_geo_data(copy.deepcopy(mtr), geo_config, session=context["session"], cache=cache)
+
+        return len(mtr["report"]["hubs"])
+
+    return run
+
+
+def bench_isp(fixtures: str, context: dict):
+    mtr = load_fixture(fixtures, "mtr")
+    geo_config = get_geo_config(context["api"], context["workdir"])
+
+    def run():
+        cache = hc.DiskCache(path=os.path.join(context["workdir"], f"isp_{time.perf_counter_ns()}.json"))
+        trace_analyzer.augment_isp(copy.deepcopy(mtr), geo_config, session=context["session"], cache=cache)
+
+        return len(mtr["report"]["hubs"])
+
+    return run
+
+
+def bench_build_map(fixtures: str, context: dict, fmt: str = "html"):
+    mtr = load_fixture(fixtures, "mtr")
+    geo_config = get_geo_config(context["api"], context["workdir"])
+
+    for he in mtr["report"]["hubs"]:
+        he["geo"] = fake_geo(he["host"]) if hs.is_public_ip(he["host"]) else {}
+
+    def run():
+        trace_analyzer.build_map(mtr, geo_config, fmt=fmt)
+
+        return len(mtr["report"]["hubs"])
+
+    return run
+
+
+def bench_build_isp(fixtures: str, context: dict):
+    mtr = load_fixture(fixtures, "mtr")
+    geo_config = get_geo_config(context["api"], context["workdir"])
+
+    for he in mtr["report"]["hubs"]:
+        asn = trace_analyzer.get_asn(he)
+        he["isp"] = {"name": f"ISP {asn}"} if asn else {}
+
+    def run():
+        trace_analyzer.build_isp(("example.com", "ipv4"), mtr, geo_config)
+
+        return len(mtr["report"]["hubs"])
+
+    return run
+
+
+def bench_iperf3(fixtures: str, context: dict):
+    report = load_fixture(fixtures, "iperf3")
+
+    def run():
+        metrics = hts.parse_iperf3(report)
+        hts.append(os.path.join(context["workdir"], f"timeseries_{time.perf_counter_ns()}"), hts.get_server(report), metrics)
+
+        return len(metrics["intervals"])
+
+    return run
+
+
+def measure(run, runs: int) -> dict:
+    """
+    This function runs the benchmark and returns the median time, throughput and the peak of the allocated memory.
+    Memory is traced in the separate run, as tracing slows the code down
+    """
+    durations = []
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Warming up the caches and lazy imports
+        items = run()
+
+        for _ in range(runs):
+            t1 = time.perf_counter()
+            run()
+            durations.append(time.perf_counter() - t1)
+
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    median = statistics.median(durations)
+
+    return {"items": items, "median_ms": round(median * 1000, 2), "items_per_s": round(items / median, 1) if median else None,
+            "peak_kb": round(peak / 1024, 1)}
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> list:
+    """
+    This function returns the regressions of the throughput and memory beyond the threshold in percent
+    """
+    regressions = []
+
+    if not baseline or baseline.get("items") != result["items"]:
+        return regressions
+
+    if baseline.get("items_per_s") and result["items_per_s"] < baseline["items_per_s"] / (1 + threshold / 100):
+        regressions.append(f"throughput {result['items_per_s']}/s vs {baseline['items_per_s']}/s")
+
+    if baseline.get("peak_kb") and result["peak_kb"] > baseline["peak_kb"] * (1 + threshold / 100):
+        regressions.append(f"memory {result['peak_kb']} KB vs {baseline['peak_kb']} KB")
+
+    return regressions
+
+
+# Variables
+benchmarks = {
+    "ifconfig": bench_ifconfig,
+    "arp": bench_arp,
+    "oui_parse": bench_oui_parse,
+    "find_vendor": bench_find_vendor,
+    "geo": bench_geo,
+    "geo_bulk": lambda fixtures, context: bench_geo(fixtures, context, bulk=True),
+    "isp": bench_isp,
+    "build_map": bench_build_map,
+    "build_map_compact": lambda fixtures, context: bench_build_map(fixtures, context, fmt="compact"),
+    "build_isp": bench_build_isp,
+    "iperf3": bench_iperf3
+}
+
+
+# Body
+if __name__ == "__main__":
+    args = args_parser()
+
+    # The paths are resolved before the benchmarks change the working directory
+    args.fixtures, args.baseline = os.path.abspath(args.fixtures), os.path.abspath(args.baseline)
+
+    if args.record or not all(os.path.exists(os.path.join(args.fixtures, fn)) for fn in fixture_files.values()):
+        print(f"Recording the fixtures to {args.fixtures}...")
+        record_fixtures(args.fixtures)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    results = {}
+    failed = {}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        context = {"api": start_mock_api(), "workdir": workdir, "session": hs.get_session(pool_size=10)}
+
+        # The renderers write their assets (e.g., lib/ of pyvis) to the working directory
+        cwd = os.getcwd()
+        os.chdir(workdir)
+
+        for name in args.benchmarks if args.benchmarks else benchmarks:
+            MockApiHandler.calls = 0
+
+            try:
+                results[name] = measure(benchmarks[name](args.fixtures, context), args.runs)
+
+            except Exception as e:
+                print(f"{name}: failed with {e.__class__.__name__}: {e}")
+                failed[name] = [f"{e.__class__.__name__}: {e}"]
+                continue
+
+            entry = results[name]
+            regressions = compare(entry, baseline.get(name), args.threshold)
+            api = f", {MockApiHandler.calls // (args.runs + 2)} API calls per run" if MockApiHandler.calls else ""
+
+            print(f"{name}: {entry['items']} items in {entry['median_ms']} ms, {entry['items_per_s']} items/s, "
+                  f"peak {entry['peak_kb']} KB{api}" + (f" - REGRESSION: {'; '.join(regressions)}" if regressions else ""))
+
+            if regressions:
+                failed[name] = regressions
+
+        os.chdir(cwd)
+
+    if args.save:
+        hs.write_json(args.baseline, {**baseline, **results})
+
+    if failed:
+        sys.exit(f"Failed or regressed beyond {args.threshold}%: {', '.join(failed)}")
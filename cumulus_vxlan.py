@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#(c)2019-2021, karneliuk.com
+
+"""
+This tool generates the IP/MAC/VLAN/VTEP mapping for Cumulus Linux.
+It takes one snapshot of the neighbor table and one snapshot of the bridge FDB in JSON format,
+indexes them and joins all the requested hosts in a single pass. The saved snapshots can be
+provided instead of the live ones to run it off-box.
+"""
+
+# Modules
+import argparse
+import csv
+import json
+import subprocess
+import sys
+
+
+# User-defined functions
+def args_parser():
+    """
+    This function contains information about arguments you provide for the script to run
+    """
+    parser = argparse.ArgumentParser(description="Generate the IP/MAC/VLAN/VTEP mapping for Cumulus Linux.")
+
+    parser.add_argument("hosts", type=str,
+                        help="Provide the file with host IPs, one per line.")
+    parser.add_argument("--neighbors", dest="neighbors", type=str, default="",
+                        help="Provide the saved output of 'ip -4 -j neighbor'. The live table is used by default.")
+    parser.add_argument("--fdb", dest="fdb", type=str, default="",
+                        help="Provide the saved output of 'bridge -j fdb show' or 'net show bridge macs json'. The live FDB is used by default.")
+    parser.add_argument("--output", dest="output", type=str, default="results.csv",
+                        help="Provide the output CSV file.")
+
+    return parser.parse_args()
+
+
+def get_snapshot(path: str, command: list) -> list:
+    """
+    This function loads the JSON snapshot from the file or collects it from the box
+    """
+    try:
+        if path:
+            with open(path, "r") as f:
+                return json.load(f)
+
+        return json.loads(subprocess.run(command, capture_output=True).stdout.decode("utf-8") or "[]")
+
+    except FileNotFoundError:
+        sys.exit(f"The snapshot {path or command[0]} cannot be found.")
+
+    except json.decoder.JSONDecodeError:
+        sys.exit(f"The snapshot {path or ' '.join(command)} is not valid JSON.")
+
+
+def index_neighbors(neighbors: list) -> dict:
+    """
+    This function indexes the neighbor table by IP: IP -> (MAC, VLAN interface)
+    """
+    result = {}
+
+    for entry in neighbors:
+        if entry.get("dst") and entry.get("lladdr"):
+            result[entry["dst"]] = (entry["lladdr"].lower(), entry.get("dev", ""))
+
+    return result
+
+
+def index_fdb(fdb: list) -> dict:
+    """
+    This function indexes the untagged FDB entries pointing to the remote VTEPs by MAC: MAC -> VTEP IP
+    """
+    result = {}
+
+    for entry in fdb:
+        vtep = entry.get("dst", entry.get("tunnel_dest"))
+
+        if entry.get("mac") and vtep and entry.get("vlan") in {None, "untagged", ""}:
+            result[entry["mac"].lower()] = vtep
+
+    return result
+
+
+def correlate(hosts: list, neighbors: dict, fdb: dict) -> list:
+    """
+    This function joins the hosts with the neighbor table and the FDB
+    """
+    result = []
+
+    for host in hosts:
+        mac, vlan = neighbors.get(host, ("", ""))
+        result.append({"host_ip": host, "host_mac": mac, "host_vlan": vlan, "switch_lo_ip": fdb.get(mac, "")})
+
+    return result
+
+
+# Body
+if __name__ == "__main__":
+    args = args_parser()
+
+    try:
+        with open(args.hosts, "r") as f:
+            hosts = [line.strip() for line in f if line.strip()]
+
+    except FileNotFoundError:
+        sys.exit(f"The hosts file {args.hosts} cannot be found.")
+
+    neighbors = index_neighbors(get_snapshot(args.neighbors, ["ip", "-4", "-j", "neighbor"]))
+    fdb = index_fdb(get_snapshot(args.fdb, ["bridge", "-j", "fdb", "show"]))
+
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["host_ip", "host_mac", "host_vlan", "switch_lo_ip"])
+        writer.writeheader()
+        writer.writerows(correlate(hosts, neighbors, fdb))
+
+    print(f"Mapped {len(hosts)} hosts. Results: {args.output}")
@@ -13,7 +13,6 @@ Two options available:
 
 
 # Modules
-import requests
 import os
 import subprocess
 import platform
@@ -23,10 +22,21 @@ import json
 import socket
 import argparse
 import datetime
+import concurrent.futures
+import ipaddress
+import contextlib
 
 
 # Local modules
 import helpers.shared as hs
+import helpers.netlink as hn
+import helpers.output as ho
+
+# Lazy modules
+asyncio = hs.lazy_import("asyncio")
+pickle = hs.lazy_import("pickle")
+hpr = hs.lazy_import("helpers.prober")
+hinv = hs.lazy_import("helpers.inventory")
 
 
 # User-defined functions
@@ -39,23 +49,66 @@ def args_parser():
     parser.add_argument("--mode", dest="mode", default="local",
                         help="Provide the execution mode. Options: local or remote.")
     parser.add_argument("--targets", dest="targets", type=str, default="",
-                        help="Provide the list of the IP ranges to be checked. Works with remote.")
+                        help="Provide the list of the IP ranges to be checked or @file with one range per line. Works with remote.")
     parser.add_argument("--detailed", action="store_true",
                         help="Specify if you want to get detailed info about local neigbors. Works with local.")
     parser.add_argument("--ipv4", action="store_true",
                         help="Specify if you want to check IPv4 reachability.")
     parser.add_argument("--ipv6", action="store_true",
                         help="Specify if you want to check IPv6 reachability.")
+    parser.add_argument("--max-parallel", dest="max_parallel", type=int, default=8,
+                        help="Provide the amount of prefixes swept concurrently. Works with fping backend.")
+    parser.add_argument("--diff", action="store_true",
+                        help="Specify if you want to get only the hosts appeared, disappeared or changed MAC since the last run.")
+    parser.add_argument("--backend", dest="backend", default="fping",
+                        help="Provide the probing backend. Options: fping or native.")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Specify if you want the randomized sweep with RTT-based timeouts and live results. Works with native backend.")
+    parser.add_argument("--rate", dest="rate", type=int, default=1000,
+                        help="Provide the probing rate in packets per second. Works with native backend.")
+    parser.add_argument("--format", dest="format", default="json",
+                        help=f"Provide the output format. Options: json (printed at the end) or {', '.join(ho.formats)} (streamed as hosts are found).")
+    ho.add_arguments(parser)
 
     result = parser.parse_args()
     result.targets = result.targets.split(",")
 
+    # Reading the target lists from files provided as @filename
+    targets = []
+    for entry in result.targets:
+        if entry.startswith("@"):
+            try:
+                with open(entry[1:], "r") as f:
+                    targets.extend([line.strip() for line in f if line.strip() and not line.startswith("#")])
+
+            except FileNotFoundError:
+                sys.exit(f"The targets file {entry[1:]} cannot be found.")
+
+        elif entry:
+            targets.append(entry)
+
+    result.targets = targets
+
+    # Hostnames aren't supported, as the prefixes are swept
+    invalid = [entry for entry in result.targets if not get_network(entry)]
+    if result.mode == "remote" and invalid:
+        sys.exit(f"The targets must be IP addresses or prefixes: {', '.join(invalid)}")
+
     if result.mode not in {"local", "remote"}:
         sys.exit("Wrong operations mode. Must be local or remote")
 
     if result.mode == "remote" and not result.targets:
         sys.exit("The remote mode is chosen, but no ranges provided.")
 
+    if result.backend not in {"fping", "native"}:
+        sys.exit("Wrong probing backend. Must be fping or native")
+
+    if result.format not in ["json"] + ho.formats:
+        sys.exit(f"Wrong output format. Must be json, {', '.join(ho.formats)}")
+
+    if result.max_parallel < 1 or result.rate < 1:
+        sys.exit("The amount of parallel sweeps and the probing rate must be at least 1.")
+
     # Setting default mode to IPv4
     if not result.ipv4 and not result.ipv6:
         result.ipv4 = True
@@ -63,6 +116,7 @@ def args_parser():
     return result
 
 
+@hs.metrics.timed("collect", source="host")
 def get_host_details():
     """
     This function collects the host details
@@ -76,13 +130,40 @@ def get_host_details():
     # Collecting IP addresses of the host
     ip_address = socket.gethostbyname_ex(hostname)
 
-    local_networks = []
-    tc = None
+    # Reading the addresses directly from the kernel on Linux, falling back to ifconfig elsewhere
+    local_networks = None
+    if hp.system == "Linux":
+        try:
+            local_networks = hn.get_networks()
+
+        except OSError:
+            local_networks = None
 
+    if local_networks is None:
+        local_networks = get_networks_ifconfig(hp)
+
+    result = {"hp": hp, "hostname": hostname, "networks": local_networks}
+
+    return result
+
+
+def get_networks_ifconfig(hp) -> list:
+    """
+    This function collects the IP addresses of the host from the ifconfig output
+    """
     raw_data = subprocess.run(["ifconfig"], capture_output=True).stdout.decode("utf-8")
-    raw_data = raw_data.splitlines()
 
-    for raw_line in  raw_data:
+    return parse_ifconfig(raw_data, hp.system)
+
+
+def parse_ifconfig(raw_data: str, system: str) -> list:
+    """
+    This function parses the ifconfig output to the list of IP addresses per interface
+    """
+    local_networks = []
+    tc = None
+
+    for raw_line in raw_data.splitlines():
         if re.match("^\w+?", raw_line):
             if tc:
                 local_networks.append(tc)
@@ -95,7 +176,7 @@ def get_host_details():
             tpx = re.sub("^.+netmask\s+([\w\.]+)\s+.*", "\g<1>", raw_line)
 
             # Converting Hex to prefix length
-            if hp.system == "Darwin":
+            if system == "Darwin":
                 tpx = bin(int(tpx, 16))[2:]
             # Converting dotted decial to prefix length
             else:
@@ -112,15 +193,18 @@ def get_host_details():
 
             tc["ipv6"].append(f"{tip}/{tpx}")
 
-    result = {"hp": hp, "hostname": hostname, "networks": local_networks}
+    # The last interface isn't followed by another one
+    if tc:
+        local_networks.append(tc)
 
-    return result
+    return local_networks
 
 
-def awake_neighbors(ip_list: list, args):
+def awake_neighbors(ip_list: list, args, on_host=None):
     """
     This functions runs fping for the connected subnets to force hosts to appear
-    in ARP table
+    in ARP table. Each live host is passed to on_host as soon as its prefix is swept
+    (or as soon as it answers in the adaptive sweep)
     """
     # Local vars
     result = []
@@ -134,67 +218,167 @@ def awake_neighbors(ip_list: list, args):
 
     else:
         for entry in ip_list:
-            if re.match("\d+\.\d+\.\d+\.\d+/\d+", entry):
-                restructured_ip_list["ipv4"].append(entry)
+            network = get_network(entry)
+
+            if not network:
+                print(f"Skipping {entry}: it is not an IP address or prefix")
 
-            elif re.match("[0-9A-Fa-f:]+?/*d*", entry):
+            # The single IPv4 address is swept as /32
+            elif network.version == 4:
+                restructured_ip_list["ipv4"].append(entry if "/" in entry else f"{entry}/32")
+
+            else:
                 restructured_ip_list["ipv6"].append(entry)
 
-    # Validating the reachebility of IPV4 host
+    # Composing the sweep tasks: IPv4 first, then IPv6, to keep the output order deterministic
+    tasks = []
     if args.ipv4:
-        for entry in restructured_ip_list["ipv4"]:
-            raw_data = subprocess.run(["fping", "-4", "-g", entry, "-a", "-q"], capture_output=True).stdout.decode("utf-8")
-            result.extend(raw_data.splitlines())
+        tasks.extend([("ipv4", entry) for entry in restructured_ip_list["ipv4"]])
 
-    # Validating the reachebility of IPV6 host
     if args.ipv6:
-        for entry in restructured_ip_list["ipv6"]:
-            raw_data = subprocess.run(["fping", "-6", entry, "-a", "-q"], capture_output=True).stdout.decode("utf-8")
-            result.extend(raw_data.splitlines())
+        tasks.extend([("ipv6", entry) for entry in restructured_ip_list["ipv6"]])
+
+    # Sweeping the prefixes concurrently, results are streamed back in the order of tasks
+    sweeps = sweep_native(tasks, args, on_host) if args.backend == "native" else sweep_fping(tasks, args)
+    streamed = args.backend == "native" and args.adaptive
+
+    with hs.metrics.span("sweep", backend=args.backend):
+        for (family, entry), (hosts, duration) in zip(tasks, sweeps):
+            print(f"Prefix {entry} ({family}): {len(hosts)} live hosts found in {duration}")
+            result.extend(hosts)
+
+            if on_host and not streamed:
+                for host in hosts:
+                    on_host({"ip": host, "family": family, "prefix": entry})
 
     return result
 
 
-def get_file(url: str, rdir: str):
+def get_scope(ip_list: list, args) -> list:
     """
-    This function downloads the file from the provided URL and stores that locally
+    This function returns the prefixes scanned in this run for the chosen address families
     """
-    # Getting filename
-    filename = url.split("/")[-1]
+    result = []
+
+    for entry in ip_list:
+        if isinstance(entry, dict):
+            result.extend(entry["ipv4"] if args.ipv4 else [])
+            result.extend(entry["ipv6"] if args.ipv6 else [])
+
+        elif get_network(entry):
+            network = get_network(entry)
+
+            if (network.version == 4 and args.ipv4) or (network.version == 6 and args.ipv6):
+                result.append(str(network))
+
+    return result
 
-    # Obtainining the file content
-    if os.path.exists(f"{rdir}/{filename}"):
-        print(f"The file '{rdir}/{filename}' already exists. Using local copy...")
 
-        with open(f"{rdir}/{filename}", "rb") as f:
-            result = f.read()
+def get_network(entry: str):
+    """
+    This function returns the IP network of the target (the address or the prefix) or None, if it is neither.
+    The scope of the link-local IPv6 address (e.g., %eth0) is ignored
+    """
+    try:
+        return ipaddress.ip_network(re.sub("%[^/]*", "", entry.strip()), strict=False)
+
+    except ValueError:
+        return None
+
+
+def sweep_fping(tasks: list, args):
+    """
+    This function sweeps the prefixes with fping in the pool of workers and yields results in the order of tasks
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_parallel) as executor:
+        yield from executor.map(lambda task: sweep_prefix(*task), tasks)
+
+
+def sweep_native(tasks: list, args, on_host=None):
+    """
+    This function sweeps all the prefixes within a single event loop and yields results in the order of tasks
+    """
+    loop = asyncio.new_event_loop()
+    prober = hpr.Prober(rate=args.rate)
+
+    try:
+        jobs = [loop.create_task(sweep_prefix_native(prober, family, entry, args.adaptive, on_alive=(
+                    lambda probe, family=family, entry=entry: on_host({"ip": probe["ip"], "family": family, "prefix": entry, "rtt": probe["rtt"]}))
+                    if on_host else None)) for family, entry in tasks]
+
+        # All the jobs progress concurrently while waiting for the first one
+        for job in jobs:
+            yield loop.run_until_complete(job)
+
+    finally:
+        prober.close()
+        loop.close()
+
+
+async def sweep_prefix_native(prober, family: str, entry: str, adaptive: bool = False, on_alive=None) -> tuple:
+    """
+    This function probes all the hosts of a single prefix with the native prober
+    """
+    t1 = datetime.datetime.now()
+
+    # IPv6 entries are checked as single hosts similar to fping
+    if family == "ipv4":
+        targets = [str(ip) for ip in ipaddress.ip_network(entry, strict=False).hosts()]
 
     else:
-        print(f"The file '{rdir}/{filename}' does not exist. Downloading...")
-        # Creating the directory to save files
-        if not os.path.exists(rdir):
-            os.mkdir(rdir)
+        targets = [entry.split("/")[0]]
 
-        # Downloading file
-        response = requests.get(url=url)
-        result = response.content
+    # The adaptive sweep reports live hosts as soon as they answer
+    if adaptive:
+        probes = await prober.adaptive_sweep(targets, on_alive=on_alive if on_alive else
+                                             lambda probe: print(f"  {probe['ip']} is alive ({probe['rtt']} ms)"))
 
-        # Saving the file
-        with open(f"{rdir}/{filename}", "wb") as f:
-            f.write(result)
+    else:
+        probes = await prober.sweep(targets)
 
-    result = result.decode("utf-8")
+    return [probe["ip"] for probe in probes if probe["alive"]], datetime.datetime.now() - t1
 
-    return result
 
+@hs.metrics.timed("exec", command="fping")
+def sweep_prefix(family: str, entry: str) -> tuple:
+    """
+    This function runs fping for a single prefix and returns the live hosts alongside the sweep duration
+    """
+    t1 = datetime.datetime.now()
+
+    if family == "ipv4":
+        raw_data = subprocess.run(["fping", "-4", "-g", entry, "-a", "-q"], capture_output=True).stdout.decode("utf-8")
+
+    else:
+        raw_data = subprocess.run(["fping", "-6", entry, "-a", "-q"], capture_output=True).stdout.decode("utf-8")
+
+    return raw_data.splitlines(), datetime.datetime.now() - t1
+
+
+def is_oui_db(path: str) -> bool:
+    """
+    This function checks that the downloaded file looks like the IEEE registry
+    """
+    with open(path, "rb") as f:
+        return b"(hex)" in f.read(65536)
 
+
+@hs.metrics.timed("collect", source="neighbors")
 def get_neighbors(hp):
     """
     This function collects the ARP table from your local host
     """
     # Local vars
-    result = []
     nix_systems = {"Darwin", "Linux"}
+    raw_output_ipv4 = ""
+
+    # Reading the ARP and NDP tables directly from the kernel on Linux, falling back to arp elsewhere
+    if hp.system == "Linux":
+        try:
+            return hn.get_neighbors()
+
+        except OSError:
+            pass
 
     # Collecting ARP table
     if hp.system in nix_systems:
@@ -203,6 +387,15 @@ def get_neighbors(hp):
         except:
             sys.exit("Something went wrong during colletion of the ARP table")
 
+    return parse_arp(raw_output_ipv4, hp.system)
+
+
+def parse_arp(raw_output_ipv4: str, system: str) -> list:
+    """
+    This function parses the 'arp -an' output to the list of neighbors
+    """
+    result = []
+
     # Convering the raw output to the list of lists
     if raw_output_ipv4:
         raw_lol = [r.split(" ") for r in raw_output_ipv4.splitlines()]
@@ -222,7 +415,7 @@ def get_neighbors(hp):
                 temp_mac = "-".join([f"0{elem}" if len(elem) == 1 else elem for elem in temp_mac.split(":")])
                 tc.update({"mac": temp_mac.upper()})
 
-                if hp.system == "Darwin":
+                if system == "Darwin":
                     # Selecting interface
                     tc.update({"interface": entry[5]})
 
@@ -234,7 +427,7 @@ def get_neighbors(hp):
                     else:
                         tc.update({"type": re.sub("\[([a-zA-Z0-9]+)\]", "\g<1>", entry[7])})
 
-                elif hp.system == "Linux":
+                elif system == "Linux":
                     # Selecting interface
                     tc.update({"interface": entry[6]})
                     # Selecting type
@@ -251,33 +444,99 @@ def get_neighbors(hp):
     return result
 
 
-def find_vendor(macs: str, neigh: list):
+@hs.metrics.timed("parse", source="oui")
+def parse_oui_db(macs: str, index: dict) -> dict:
     """
-    This function searches for the NIC vendors in the IEEE DB
+    This function parses the IEEE registry (MA-L, MA-M or MA-S) into the OUI index.
+    The index is keyed by the prefix length (24, 28 or 36 bits) and then by the prefix integer
     """
-    # local vars
-    clean_mac_db = []
+    # Local vars
+    pending = None
 
-    # Creating MAC DB in Python dictionary format
     for entry in macs.splitlines():
-        if re.match("^[A-Z0-9]+\-", entry):
-            tc = {}
-            tc.update({"oui": entry.split(" ")[0]})
-            tc.update({"vendor": entry.split("\t\t")[1]})
+        # Remembering the 24-bit OUI and vendor
+        if re.match("^[A-Z0-9]+\-", entry) and "(hex)" in entry:
+            pending = (int(entry.split(" ")[0].replace("-", ""), 16), entry.split("\t\t")[1])
+
+        # Resolving the block size from the base 16 line following the OUI
+        elif pending and "(base 16)" in entry:
+            block = entry.split()[0]
+
+            if "-" in block:
+                start, end = [int(elem, 16) for elem in block.split("-")]
+                plen = 48 - (end - start + 1).bit_length() + 1
+                index[plen][((pending[0] << 24) | start) >> (48 - plen)] = pending[1]
+
+            else:
+                index[24][pending[0]] = pending[1]
+
+            pending = None
+
+    return index
+
+
+@hs.metrics.timed("oui_index")
+def get_oui_index(urls: list, rdir: str, max_age: int = 604800) -> dict:
+    """
+    This function returns the precompiled OUI index and rebuilds it only if the IEEE registries changed
+    """
+    # Local vars
+    files = [hs.fetch_file(url=url, rdir=rdir, max_age=max_age, validate=is_oui_db) for url in urls]
+    index_file = f"{rdir}/oui_index.pickle"
 
-            clean_mac_db.append(tc)
+    fingerprint = [(os.path.getsize(f), os.path.getmtime(f)) if os.path.exists(f) else None for f in files]
 
+    if None not in fingerprint and os.path.exists(index_file):
+        with open(index_file, "rb") as f:
+            cached = pickle.load(f)
+
+        if cached["fingerprint"] == fingerprint:
+            print(f"The OUI index '{index_file}' is up to date. Using local copy...")
+
+            return cached["index"]
+
+    print(f"Compiling the OUI index '{index_file}'...")
+    result = {24: {}, 28: {}, 36: {}}
+
+    # The registries are already fetched above, so they are not revalidated again
+    for path in files:
+        with open(path, "rb") as f:
+            parse_oui_db(macs=f.read().decode("utf-8"), index=result)
+
+    fingerprint = [(os.path.getsize(f), os.path.getmtime(f)) for f in files]
+
+    with open(index_file, "wb") as f:
+        pickle.dump({"fingerprint": fingerprint, "index": result}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return result
+
+
+def lookup_vendor(index: dict, mac: str):
+    """
+    This function returns the vendor for the MAC using the longest matching prefix (MA-S, MA-M, MA-L)
+    """
+    mac_int = int(mac.replace("-", "").replace(":", ""), 16)
+
+    for plen in (36, 28, 24):
+        vendor = index[plen].get(mac_int >> (48 - plen))
+
+        if vendor is not None:
+            return vendor
+
+    return None
+
+
+@hs.metrics.timed("vendor_lookup")
+def find_vendor(macs: dict, neigh: list):
+    """
+    This function searches for the NIC vendors in the IEEE DB
+    """
     # Searching for vendors based on MAC
     for entry in neigh:
         entry.update({"vendor": None})
 
         if entry["type"] == "ethernet":
-            # Subtracting OUI
-            mac_query = "-".join(entry["mac"].split("-")[0:3])
-            
-            for sentry in clean_mac_db:
-                if sentry["oui"] == mac_query:
-                    entry.update({"vendor": sentry["vendor"]})
+            entry.update({"vendor": lookup_vendor(index=macs, mac=entry["mac"])})
 
     return neigh
 
@@ -292,22 +551,64 @@ if __name__ == "__main__":
     # Get arguments
     args = args_parser()
 
-    # Timestamping
-    t1 = datetime.datetime.now()
-    print(f"Starting validation at {t1}...")
+    # Streaming the results, while the progress goes to stderr, if the results go to stdout
+    writer = ho.open_writer(args, fields=["change", "ip", "family", "prefix", "rtt", "mac", "old_mac", "vendor", "interface", "type",
+                                          "last_seen"]) if args.format != "json" else None
+    on_host = writer.write if writer and not args.diff and not args.detailed else None
 
-    # Collecting info about live hosts
-    if args.mode == "remote":
-        live_hosts = awake_neighbors(args.targets, args)
+    with contextlib.redirect_stdout(sys.stderr) if writer and args.output == "-" else contextlib.nullcontext():
+        # Timestamping
+        t1 = datetime.datetime.now()
+        print(f"Starting validation at {t1}...")
 
-    else: 
-        live_hosts = awake_neighbors(host_data["networks"], args)
+        # Collecting info about live hosts
+        if args.mode == "remote":
+            live_hosts = awake_neighbors(args.targets, args, on_host)
 
-        if args.detailed:
-            macdb = get_file(url=config["urls"]["mac_db"], rdir=config["paths"]["cache"])
+        else:
+            live_hosts = awake_neighbors(host_data["networks"], args, on_host)
+
+        # Opening the hosts inventory (and loading SQLite) only once the sweep is done
+        inventory = hinv.open_inventory(f"{config['paths']['cache']}/inventory.sqlite")
+
+        if args.mode == "local" and args.detailed:
             live_hosts = get_neighbors(host_data["hp"])
-            live_hosts = find_vendor(macs=macdb, neigh=live_hosts)
 
-    # Results
-    print(f"\nValidation completed in {datetime.datetime.now() - t1}.\n\nAmount of live hosts: {len(live_hosts)}\n\nDetails:")
-    print(json.dumps(live_hosts, indent=4))
\ No newline at end of file
+            # Looking up vendors only for MACs not known in the inventory yet
+            known = hinv.known_vendors(inventory, [entry["mac"] for entry in live_hosts])
+            unknown = []
+
+            for entry in live_hosts:
+                entry.update({"vendor": known.get(entry["mac"])})
+
+                if entry["mac"] not in known and entry["type"] == "ethernet":
+                    unknown.append(entry)
+
+            if unknown:
+                mac_urls = [config["urls"][key] for key in ("mac_db", "mac_db_mam", "mac_db_mas") if key in config["urls"]]
+                macdb = get_oui_index(urls=mac_urls, rdir=config["paths"]["cache"], max_age=config["paths"].get("max_age", 604800))
+                find_vendor(macs=macdb, neigh=unknown)
+
+        # Updating the inventory within the scanned prefixes
+        with hs.metrics.span("inventory"):
+            changes = hinv.update_inventory(inventory, [entry if isinstance(entry, dict) else {"ip": entry} for entry in live_hosts],
+                                            scope=get_scope(host_data["networks"] if args.mode == "local" else args.targets, args))
+
+        hs.metrics.count("live_hosts", len(live_hosts))
+        hs.metrics.count("inventory_changes", len(changes))
+
+        # Results
+        print(f"\nValidation completed in {datetime.datetime.now() - t1}.\n\nAmount of live hosts: {len(live_hosts)}")
+
+        if not writer:
+            print(f"\nDetails:\n{json.dumps(changes if args.diff else live_hosts, indent=4)}")
+            sys.exit()
+
+        # The changes and the neighbor details are known only once all the hosts are collected
+        for entry in changes if args.diff else live_hosts if args.detailed else []:
+            writer.write(entry)
+
+        writer.close()
+
+        if args.output != "-":
+            print(f"Results: {', '.join(writer.files)}")
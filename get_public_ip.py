@@ -3,22 +3,288 @@
 
 """
 This tool provides the resultion of the public IP address to the author.
+It queries several providers concurrently and returns the first answer confirmed by the quorum of them.
+With --repeat it becomes the latency probe: each provider is polled over its keep-alive connection and
+the latency is split into DNS, connect, TLS and time to the first byte (TTFB) with percentiles.
 """
 
 # Modules
+import argparse
+import concurrent.futures
 import datetime
-import requests
-import yaml
+import http.client
+import ipaddress
+import json
+import socket
+import ssl
+import sys
+import time
+import urllib.parse
 
 # Local modules
 import helpers.shared as hs
+import helpers.timeseries as hts
+
+
+# Classes
+class Provider:
+    """
+    This class keeps the connection to the public IP provider and the latency samples of each check
+    """
+    def __init__(self, url: str, timeout: float = 5.0, context: ssl.SSLContext = None, reuse: bool = True):
+        parsed = urllib.parse.urlsplit(url)
+
+        self.url = url
+        self.tls = parsed.scheme == "https"
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.tls else 80)
+        self.path = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+        self.timeout = timeout
+        self.context = context if context else ssl.create_default_context()
+        self.reuse = reuse
+        self.samples = []
+        self._conn = None
+
+    def _connect(self) -> dict:
+        """
+        This method opens the connection and times each phase of it
+        """
+        result = {"dns": 0.0, "connect": 0.0, "tls": 0.0}
+
+        t1 = time.perf_counter()
+        family, socktype, proto, _, address = socket.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)[0]
+        t2 = time.perf_counter()
+        result["dns"] = t2 - t1
+
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(self.timeout)
+
+        try:
+            sock.connect(address)
+            t3 = time.perf_counter()
+            result["connect"] = t3 - t2
+
+            if self.tls:
+                sock = self.context.wrap_socket(sock, server_hostname=self.host)
+                result["tls"] = time.perf_counter() - t3
+
+        except (OSError, ssl.SSLError):
+            sock.close()
+            raise
+
+        self._conn = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.context) if self.tls \
+            else http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        self._conn.sock = sock
+
+        return result
+
+    def _request(self) -> tuple:
+        """
+        This method sends the request and returns the TTFB (till the status line and headers) and the body
+        """
+        t1 = time.perf_counter()
+        self._conn.request("GET", self.path, headers={"Host": self.host, "Accept": "application/json, text/plain"})
+        response = self._conn.getresponse()
+        ttfb = time.perf_counter() - t1
+        body = response.read()
+        hs.metrics.count("http_requests", host=self.host, status=response.status)
+
+        if response.will_close or not self.reuse:
+            self.close()
+
+        if response.status != 200:
+            raise http.client.HTTPException(f"HTTP {response.status}")
+
+        return ttfb, body
+
+    def check(self) -> str:
+        """
+        This method runs a single check and records its sample. The stale keep-alive connection is reopened once
+        """
+        sample = {"dns": 0.0, "connect": 0.0, "tls": 0.0, "ttfb": None, "total": None, "ip": None, "error": None}
+        t1 = time.perf_counter()
+        hs.metrics.count("checks", provider=self.host)
+
+        try:
+            for attempt in range(2):
+                reused = self._conn is not None
+
+                if not reused:
+                    sample.update(self._connect())
+
+                try:
+                    sample["ttfb"], body = self._request()
+                    break
+
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    self.close()
+
+                    if not reused or attempt:
+                        raise
+
+            sample["ip"] = parse_ip(body)
+            sample["total"] = time.perf_counter() - t1
+
+        except (OSError, ssl.SSLError, http.client.HTTPException, ValueError) as e:
+            self.close()
+            sample["error"] = str(e) or e.__class__.__name__
+            hs.metrics.count("check_errors", provider=self.host)
+
+        self.samples.append(sample)
+
+        # The phases are reported as spans as well, so they are exported with the rest of metrics
+        for phase in ["dns", "connect", "tls", "ttfb"]:
+            if sample[phase]:
+                hs.metrics.record(phase, sample[phase], provider=self.host)
+
+        return sample["ip"]
+
+    def close(self) -> None:
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+# User-defined functions
+def args_parser():
+    """
+    This function contains information about arguments you provide for the script to run
+    """
+    parser = argparse.ArgumentParser(description="Resolve the public IP and measure the latency towards the providers.")
+
+    parser.add_argument("--providers", dest="providers", type=str, default="",
+                        help="Provide the comma-separated URLs of the providers. By default urls.public_ip from config.yml is used.")
+    parser.add_argument("--quorum", dest="quorum", type=int, default=0,
+                        help="Provide the amount of providers, which must return the same IP. By default 2 (or 1 with a single provider).")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=1,
+                        help="Provide the amount of checks per provider to collect the latency statistics.")
+    parser.add_argument("--interval", dest="interval", type=float, default=1.0,
+                        help="Provide the interval between the checks in seconds.")
+    parser.add_argument("--timeout", dest="timeout", type=float, default=5.0,
+                        help="Provide the timeout per check in seconds.")
+    parser.add_argument("--no-reuse", dest="no_reuse", action="store_true",
+                        help="Specify if each check shall open a new connection to measure DNS, connect and TLS every time.")
+    parser.add_argument("--cafile", dest="cafile", type=str, default=None,
+                        help="Provide the CA bundle to verify the providers' certificates.")
+    parser.add_argument("--format", dest="format", type=str, default="text",
+                        help="Provide the output format. Options: text or json.")
+
+    result = parser.parse_args()
+
+    if result.format not in {"text", "json"}:
+        sys.exit("Wrong output format. Must be text or json")
+
+    if result.repeat < 1:
+        sys.exit("The repeat must be at least 1.")
+
+    return result
+
+
+def parse_ip(body: bytes) -> str:
+    """
+    This function extracts the IP from the provider's response, which is either JSON with the "ip" key or plain text
+    """
+    text = body.decode("utf-8").strip()
+
+    try:
+        data = json.loads(text)
+        text = data["ip"] if isinstance(data, dict) else str(data)
+
+    except (json.decoder.JSONDecodeError, KeyError):
+        pass
+
+    return ipaddress.ip_address(text).compressed
+
+
+def get_consensus(futures: list, quorum: int) -> tuple:
+    """
+    This function waits for the concurrent checks and returns the first IP reported by the quorum of providers,
+    together with the time to reach it
+    """
+    votes = {}
+    t1 = time.perf_counter()
+
+    for future in concurrent.futures.as_completed(futures):
+        ip = future.result()
+
+        if ip:
+            votes[ip] = votes.get(ip, 0) + 1
+
+            if votes[ip] >= quorum:
+                return ip, time.perf_counter() - t1
+
+    return None, time.perf_counter() - t1
+
+
+def get_stats(samples: list) -> dict:
+    """
+    This function returns the percentiles of each latency phase in ms. The phases skipped due to
+    the reused connection are not counted
+    """
+    result = {"checks": len(samples), "errors": len([s for s in samples if s["error"]]),
+              "last_error": next((s["error"] for s in reversed(samples) if s["error"]), None)}
+    completed = [s for s in samples if not s["error"]]
+
+    for phase in ["dns", "connect", "tls", "ttfb", "total"]:
+        values = [s[phase] * 1000 for s in completed if s[phase]]
+
+        result[phase] = {"count": len(values), "min": round(min(values), 3), "p50": round(hts.percentile(values, 50), 3),
+                         "p90": round(hts.percentile(values, 90), 3), "p99": round(hts.percentile(values, 99), 3),
+                         "max": round(max(values), 3)} if values else None
+
+    return result
+
 
 # Body
 if __name__ == "__main__":
     # Import configuration file
     config = hs.import_config("./config.yml")
+    args = args_parser()
+
+    urls = args.providers.split(",") if args.providers else config["urls"].get("public_ip", [config["urls"]["geo_ip"]])
+    quorum = args.quorum if args.quorum else min(2, len(urls))
+    context = ssl.create_default_context(cafile=args.cafile)
+    providers = [Provider(url, timeout=args.timeout, context=context, reuse=not args.no_reuse) for url in urls]
 
     # Polling the public IP
     t1 = datetime.datetime.now()
-    ip = requests.get(url=config["urls"]["geo_ip"]).json()
-    print(f"Request started at: {t1}\nRequested completed within: {datetime.datetime.now() - t1}\nYour IP is: {ip['ip']}")
\ No newline at end of file
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(providers)) as executor:
+        futures = [executor.submit(provider.check) for provider in providers]
+        ip, duration = get_consensus(futures, quorum)
+
+        if args.format == "text":
+            print(f"Request started at: {t1}\nRequested completed within: {datetime.timedelta(seconds=duration)}\nYour IP is: {ip}")
+
+        # Collecting the latency statistics, once the slower providers have answered as well
+        concurrent.futures.wait(futures)
+
+        for _ in range(args.repeat - 1):
+            time.sleep(args.interval)
+            list(executor.map(lambda provider: provider.check(), providers))
+
+    for provider in providers:
+        provider.close()
+
+    # Providers reporting the different IP or failing
+    answers = {provider.url: {s["ip"] for s in provider.samples if s["ip"]} for provider in providers}
+    disagree = [url for url, ips in answers.items() if ips and ips != {ip}]
+    result = {"ip": ip, "quorum": quorum, "duration": round(duration * 1000, 3), "inconsistent": disagree,
+              "providers": {provider.url: get_stats(provider.samples) for provider in providers}}
+
+    if args.format == "json":
+        print(json.dumps(result, indent=4))
+
+    else:
+        for url in disagree:
+            print(f"Warning: {url} reported {', '.join(sorted(answers[url]))}")
+
+        for url, stats in result["providers"].items():
+            print(f"\n{url}: {stats['checks']} checks, {stats['errors']} errors" + (f" (last: {stats['last_error']})" if stats["errors"] else ""))
+
+            for phase in ["dns", "connect", "tls", "ttfb", "total"]:
+                if stats[phase]:
+                    print(f"  {phase:<8} " + " ".join(f"{k}={v}" for k, v in stats[phase].items()))
+
+    if not ip:
+        sys.exit(f"No IP confirmed by {quorum} providers.")
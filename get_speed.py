@@ -17,21 +17,27 @@ import datetime
 import subprocess
 import json
 import ssl
+import smtplib
 from getpass import getpass
 
+# Local modules
+import helpers.shared as hs
+
 # Variables
 mail = {'server': 'mail.com', 'port': 465, 'password': getpass('Mail password > '), 'source': 'test@mail.com', 'destination': 'test@mail.com'}
 
 # Body
 if __name__ == "__main__":
     t1 = datetime.datetime.now()
-    speed_details = json.loads(subprocess.run(['speedtest', '-f', 'json'], stdout=subprocess.PIPE).stdout.decode('utf-8'))
+    with hs.metrics.span("exec", command="speedtest"):
+        speed_details = json.loads(subprocess.run(['speedtest', '-f', 'json'], stdout=subprocess.PIPE).stdout.decode('utf-8'))
+
     result = f"Request started at: {t1}\nRequested completed within: {datetime.datetime.now() - t1}\nYour Downlink BW is {speed_details['download']['bandwidth'] * 8} bps and Uplink BW is {speed_details['upload']['bandwidth'] * 8} bps"
     print(result)
 
     # Mailing report
     context = ssl.create_default_context()
 
-    with smtplib.SMTP_SSL(mail['server'], port=mail['port'], context=context) as server:
+    with hs.metrics.span("mail"), smtplib.SMTP_SSL(mail['server'], port=mail['port'], context=context) as server:
         server.login(mail['source'], mail['password'])
         server.sendmail(from_addr=mail['source'], to_addrs=mail['destination'], msg=result)
\ No newline at end of file
@@ -0,0 +1,190 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module contains the per-(destination, hop IP) latency baseline for the repeated traces.
+Each hop keeps only the streaming estimators (EWMA of RTT and loss, Welford mean/variance and the P2 quantile
+sketch) in SQLite, so the memory per hop is constant and the new trace is checked without reloading the history.
+"""
+
+# Modules
+import sqlite3
+import datetime
+import json
+import math
+import os
+
+
+# Variables
+defaults = {"alpha": 0.1, "quantile": 0.95, "sigma": 3.0, "min_samples": 10, "min_delta": 5.0, "loss_delta": 10.0}
+
+
+# User-defined functions
+def open_baseline(path: str) -> sqlite3.Connection:
+    """
+    This function opens the baseline database and creates the schema, if needed
+    """
+    rdir = os.path.dirname(path)
+    if rdir and not os.path.exists(rdir):
+        os.makedirs(rdir)
+
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE IF NOT EXISTS hops (dst TEXT, host TEXT, state TEXT, last_seen TEXT, PRIMARY KEY (dst, host))")
+    conn.execute("CREATE TABLE IF NOT EXISTS paths (dst TEXT PRIMARY KEY, hops TEXT, last_seen TEXT)")
+
+    return conn
+
+
+def p2_update(state: dict, value: float, q: float) -> None:
+    """
+    This function adds the value to the P2 quantile sketch (Jain and Chlamtac), which keeps 5 markers only
+    """
+    heights = state.setdefault("q", [])
+
+    # The first 5 values initialize the markers
+    if len(heights) < 5:
+        heights.append(value)
+        heights.sort()
+
+        if len(heights) == 5:
+            state["n"] = [1, 2, 3, 4, 5]
+            state["np"] = [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5]
+
+        return
+
+    positions, desired = state["n"], state["np"]
+
+    if value < heights[0]:
+        heights[0] = value
+        k = 0
+
+    elif value >= heights[4]:
+        heights[4] = value
+        k = 3
+
+    else:
+        k = max(i for i in range(4) if heights[i] <= value)
+
+    for i in range(k + 1, 5):
+        positions[i] += 1
+
+    for i, increment in enumerate([0, q / 2, q, (1 + q) / 2, 1]):
+        desired[i] += increment
+
+    # Adjusting the middle markers with the parabolic or, if it overshoots, the linear formula
+    for i in range(1, 4):
+        delta = desired[i] - positions[i]
+
+        if (delta >= 1 and positions[i + 1] - positions[i] > 1) or (delta <= -1 and positions[i - 1] - positions[i] < -1):
+            d = 1 if delta > 0 else -1
+            parabolic = heights[i] + d / (positions[i + 1] - positions[i - 1]) * (
+                (positions[i] - positions[i - 1] + d) * (heights[i + 1] - heights[i]) / (positions[i + 1] - positions[i]) +
+                (positions[i + 1] - positions[i] - d) * (heights[i] - heights[i - 1]) / (positions[i] - positions[i - 1]))
+
+            if heights[i - 1] < parabolic < heights[i + 1]:
+                heights[i] = parabolic
+
+            else:
+                heights[i] += d * (heights[i + d] - heights[i]) / (positions[i + d] - positions[i])
+
+            positions[i] += d
+
+
+def p2_value(state: dict, q: float) -> float:
+    """
+    This function returns the estimated quantile
+    """
+    heights = state.get("q", [])
+
+    if not heights:
+        return math.nan
+
+    return heights[2] if len(heights) == 5 else heights[min(len(heights) - 1, int(q * len(heights)))]
+
+
+def update_hop(state: dict, rtt: float, loss: float, settings: dict) -> dict:
+    """
+    This function adds the hop measurement (Avg and Loss% of a single trace) to the estimators
+    """
+    state["samples"] = state.get("samples", 0) + 1
+
+    # EWMA is seeded with the first measurement
+    state["ewma"] = rtt if state["samples"] == 1 else settings["alpha"] * rtt + (1 - settings["alpha"]) * state["ewma"]
+    state["ewma_loss"] = loss if state["samples"] == 1 else settings["alpha"] * loss + (1 - settings["alpha"]) * state["ewma_loss"]
+
+    # Welford variance
+    delta = rtt - state.get("mean", 0.0)
+    state["mean"] = state.get("mean", 0.0) + delta / state["samples"]
+    state["m2"] = state.get("m2", 0.0) + delta * (rtt - state["mean"])
+
+    p2_update(state.setdefault("p2", {}), rtt, settings["quantile"])
+
+    return state
+
+
+def get_baseline(state: dict, settings: dict) -> dict:
+    """
+    This function returns the current baseline of the hop
+    """
+    samples = state.get("samples", 0)
+
+    return {"samples": samples, "ewma": round(state.get("ewma", math.nan), 3),
+            "stdev": round(math.sqrt(state["m2"] / (samples - 1)), 3) if samples > 1 else 0.0,
+            f"p{round(settings['quantile'] * 100)}": round(p2_value(state.get("p2", {}), settings["quantile"]), 3),
+            "ewma_loss": round(state.get("ewma_loss", math.nan), 2)}
+
+
+def check_trace(conn: sqlite3.Connection, dst: str, hubs: list, settings: dict = None) -> list:
+    """
+    This function checks the trace (hubs in the MTR JSON format) against the baseline, then adds it to the baseline.
+    It returns the anomalies: latency (the hop is slower than both EWMA + sigma * stdev and the quantile),
+    loss (the loss increase persists till the last hop, so ICMP rate limiting at the transit hop is ignored)
+    and path_changed
+    """
+    settings = {**defaults, **(settings if settings else {})}
+    result = []
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    hops = [hub for hub in hubs if hub.get("host") and hub["host"] != "???"]
+
+    states = {row["host"]: json.loads(row["state"]) for row in
+              conn.execute(f"SELECT host, state FROM hops WHERE dst = ? AND host IN ({','.join('?' * len(hops))})",
+                           [dst] + [hub["host"] for hub in hops])} if hops else {}
+
+    # Path change is checked on the sequence of the responding hops
+    path = [hub["host"] for hub in hops]
+    row = conn.execute("SELECT hops FROM paths WHERE dst = ?", (dst,)).fetchone()
+
+    if row and json.loads(row["hops"]) != path:
+        result.append({"dst": dst, "anomaly": "path_changed", "old_path": json.loads(row["hops"]), "new_path": path})
+
+    # Loss increase over the baseline per hop, the minimum over the remaining hops shows if it persists
+    loss_increase = [hub.get("Loss%", 0.0) - states.get(hub["host"], {}).get("ewma_loss", hub.get("Loss%", 0.0)) for hub in hops]
+    persistent = [min(loss_increase[i:]) for i in range(len(loss_increase))]
+
+    rows = []
+    for index, hub in enumerate(hops):
+        state = states.get(hub["host"], {})
+        baseline = get_baseline(state, settings)
+        received = hub.get("Loss%", 0.0) < 100
+
+        if state.get("samples", 0) >= settings["min_samples"]:
+            quantile = baseline[f"p{round(settings['quantile'] * 100)}"]
+            threshold = max(baseline["ewma"] + settings["sigma"] * baseline["stdev"], quantile, baseline["ewma"] + settings["min_delta"])
+
+            if received and hub["Avg"] > threshold:
+                result.append({"dst": dst, "anomaly": "latency", "hop": hub["count"], "host": hub["host"],
+                               "avg": hub["Avg"], "threshold": round(threshold, 3), "baseline": baseline})
+
+            if persistent[index] >= settings["loss_delta"] and (index == 0 or persistent[index - 1] < settings["loss_delta"]):
+                result.append({"dst": dst, "anomaly": "loss", "hop": hub["count"], "host": hub["host"],
+                               "loss": hub.get("Loss%", 0.0), "baseline": baseline})
+
+        if received:
+            update_hop(state, hub["Avg"], hub.get("Loss%", 0.0), settings)
+            rows.append((dst, hub["host"], json.dumps(state), now))
+
+    conn.executemany("INSERT OR REPLACE INTO hops VALUES (?, ?, ?, ?)", rows)
+    conn.execute("INSERT OR REPLACE INTO paths VALUES (?, ?, ?)", (dst, json.dumps(path), now))
+    conn.commit()
+
+    return result
@@ -0,0 +1,89 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module contains the persistent on-disk cache with expiry, which is shared across the tools.
+"""
+
+# Modules
+import json
+import os
+import threading
+import time
+
+# Local modules
+import helpers.shared as hs
+
+
+# Classes
+class DiskCache:
+    """
+    This class keeps the key-value pairs with expiry in a JSON file. The updates and saves are locked,
+    so the cache can be shared by the concurrent jobs of probe_daemon
+    """
+    def __init__(self, path: str, ttl: int = 86400, negative_ttl: int = 300):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._data = {}
+        self._changed = False
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self._data = json.load(f)
+
+            except (json.decoder.JSONDecodeError, OSError):
+                self._data = {}
+
+        # Dropping expired entries
+        now = time.time()
+        self._data = {k: v for k, v in self._data.items() if v["expires"] > now}
+
+    def __contains__(self, key: str) -> bool:
+        entry = self._data.get(key)
+
+        if entry and entry["expires"] > time.time():
+            self.hits += 1
+            hs.metrics.count("cache_lookups", cache=os.path.basename(self.path), result="hit")
+            return True
+
+        self.misses += 1
+        hs.metrics.count("cache_lookups", cache=os.path.basename(self.path), result="miss")
+        return False
+
+    def get(self, key: str, default=None):
+        entry = self._data.get(key)
+
+        return entry["value"] if entry and entry["expires"] > time.time() else default
+
+    def set(self, key: str, value, negative: bool = False) -> None:
+        """
+        This function stores the value. The negative entries (failed lookups) expire faster
+        """
+        ttl = self.negative_ttl if negative else self.ttl
+
+        with self._lock:
+            self._data[key] = {"value": value, "expires": time.time() + ttl}
+            self._changed = True
+
+    def save(self) -> None:
+        """
+        This function writes the cache to disk atomically, if anything changed
+        """
+        with self._lock:
+            if not self._changed:
+                return
+
+            rdir = os.path.dirname(self.path)
+            if rdir and not os.path.exists(rdir):
+                os.makedirs(rdir)
+
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump(self._data, f)
+
+            os.replace(f"{self.path}.tmp", self.path)
+            self._changed = False
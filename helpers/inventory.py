@@ -0,0 +1,126 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module contains the persistent inventory of the hosts found by get_nodes.py.
+It keeps first-seen/last-seen timestamps per IP/MAC in SQLite and returns only the changes of each run.
+"""
+
+# Modules
+import sqlite3
+import datetime
+import ipaddress
+import json
+import os
+
+
+# User-defined functions
+def open_inventory(path: str) -> sqlite3.Connection:
+    """
+    This function opens the inventory database and creates the schema, if needed
+    """
+    rdir = os.path.dirname(path)
+    if rdir and not os.path.exists(rdir):
+        os.makedirs(rdir)
+
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE IF NOT EXISTS hosts (ip TEXT PRIMARY KEY, mac TEXT, vendor TEXT, details TEXT, "
+                 "first_seen TEXT, last_seen TEXT, present INTEGER, ip_key TEXT)")
+
+    # The inventories created before ip_key get it filled once
+    if "ip_key" not in [row["name"] for row in conn.execute("PRAGMA table_info(hosts)")]:
+        conn.execute("ALTER TABLE hosts ADD COLUMN ip_key TEXT")
+        conn.executemany("UPDATE hosts SET ip_key = ? WHERE ip = ?", [(get_key(row["ip"]), row["ip"]) for row in conn.execute("SELECT ip FROM hosts")])
+        conn.commit()
+
+    conn.execute("CREATE INDEX IF NOT EXISTS hosts_mac ON hosts (mac)")
+    conn.execute("CREATE INDEX IF NOT EXISTS hosts_key ON hosts (ip_key)")
+
+    return conn
+
+
+def get_key(ip) -> str:
+    """
+    This function returns the key of the IP address, which sorts as the address within its family,
+    so the hosts of the prefix are selected by the range of keys
+    """
+    try:
+        address = ipaddress.ip_address(str(ip).split("%")[0])
+
+    except ValueError:
+        return None
+
+    return f"{address.version}{int(address):0{address.max_prefixlen // 4}x}"
+
+
+def known_vendors(conn: sqlite3.Connection, macs: list) -> dict:
+    """
+    This function returns the vendors of the MACs already known in the inventory
+    """
+    result = {}
+    macs = list(set(macs))
+
+    # Keeping below the SQLite limit of the variables per query
+    for i in range(0, len(macs), 500):
+        chunk = macs[i:i + 500]
+        query = f"SELECT mac, vendor FROM hosts WHERE vendor IS NOT NULL AND mac IN ({','.join('?' * len(chunk))})"
+        result.update({row["mac"]: row["vendor"] for row in conn.execute(query, chunk)})
+
+    return result
+
+
+def update_inventory(conn: sqlite3.Connection, hosts: list, scope: list) -> list:
+    """
+    This function records the hosts found and returns the changes: appeared, disappeared and mac_changed.
+    Only the hosts within the scanned scope (list of prefixes) can disappear
+    """
+    result = []
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    networks = [ipaddress.ip_network(entry, strict=False) for entry in scope]
+
+    # Only the hosts within the scope or found in this run are loaded
+    existing = {}
+    for net in networks:
+        existing.update({row["ip"]: row for row in conn.execute("SELECT * FROM hosts WHERE ip_key BETWEEN ? AND ?",
+                                                                (get_key(net.network_address), get_key(net.broadcast_address)))})
+
+    missing = list({host["ip"] for host in hosts} - set(existing))
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        existing.update({row["ip"]: row for row in conn.execute(f"SELECT * FROM hosts WHERE ip IN ({','.join('?' * len(chunk))})", chunk)})
+
+    seen = set()
+    rows = []
+
+    for host in hosts:
+        ip, mac, vendor = host["ip"], host.get("mac"), host.get("vendor")
+        row = existing.get(ip)
+        seen.add(ip)
+
+        if not row or not row["present"]:
+            result.append({"change": "appeared", **host})
+
+        elif mac and row["mac"] and mac != row["mac"]:
+            result.append({"change": "mac_changed", "old_mac": row["mac"], **host})
+
+        rows.append((ip, mac, vendor, json.dumps(host), row["first_seen"] if row else now, now, 1, get_key(ip)))
+
+    # The hosts without MAC (non-detailed or remote runs) keep the MAC, vendor and details known from the earlier runs
+    conn.executemany("INSERT INTO hosts (ip, mac, vendor, details, first_seen, last_seen, present, ip_key) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (ip) DO UPDATE SET "
+                     "mac = COALESCE(excluded.mac, mac), "
+                     "vendor = CASE WHEN excluded.mac IS NULL THEN vendor WHEN excluded.mac = mac THEN COALESCE(excluded.vendor, vendor) "
+                     "ELSE excluded.vendor END, "
+                     "details = CASE WHEN excluded.mac IS NULL THEN details ELSE excluded.details END, "
+                     "last_seen = excluded.last_seen, present = excluded.present", rows)
+
+    gone = []
+    for ip, row in existing.items():
+        if row["present"] and ip not in seen and any(ipaddress.ip_address(ip) in net for net in networks):
+            result.append({"change": "disappeared", **json.loads(row["details"]), "last_seen": row["last_seen"]})
+            gone.append((ip,))
+
+    conn.executemany("UPDATE hosts SET present = 0 WHERE ip = ?", gone)
+    conn.commit()
+
+    return result
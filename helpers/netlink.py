@@ -0,0 +1,225 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module contains the Linux collector of the interfaces and neighbors, which reads the data directly
+from /proc/net/arp, /proc/net/if_inet6 and rtnetlink dumps instead of running ifconfig and arp.
+The parsers take the raw text or bytes, so the captured dumps can be replayed on any platform.
+"""
+
+# Modules
+import socket
+import struct
+import ipaddress
+import os
+
+
+# Variables
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+RTM_NEWNEIGH = 28
+RTM_GETNEIGH = 30
+NLM_F_REQUEST = 0x01
+NLM_F_DUMP = 0x300
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+NDA_DST = 1
+NDA_LLADDR = 2
+
+NUD_INCOMPLETE = 0x01
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+
+
+# User-defined functions
+def netlink_dump(msg_type: int, family: int) -> bytes:
+    """
+    This function requests the rtnetlink dump and returns the raw response
+    """
+    # ifaddrmsg and ndmsg have the address family as the first byte
+    payload = struct.pack("=BBBBI", family, 0, 0, 0, 0) if msg_type == RTM_GETADDR else struct.pack("=BBHiHBB", family, 0, 0, 0, 0, 0, 0)
+    request = struct.pack("=IHHII", 16 + len(payload), msg_type, NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + payload
+
+    result = b""
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+        sock.send(request)
+
+        while True:
+            data = sock.recv(65536)
+            result += data
+
+            if any(t in {NLMSG_DONE, NLMSG_ERROR} for t, _ in iter_messages(data)):
+                break
+
+    return result
+
+
+def iter_messages(data: bytes):
+    """
+    This function yields the type and body of each netlink message in the buffer
+    """
+    offset = 0
+
+    while offset + 16 <= len(data):
+        length, msg_type = struct.unpack_from("=IH", data, offset)
+
+        if length < 16:
+            break
+
+        yield msg_type, data[offset + 16:offset + length]
+        offset += (length + 3) & ~3
+
+
+def parse_attributes(data: bytes) -> dict:
+    """
+    This function parses the rtnetlink attributes (rtattr) to the dictionary
+    """
+    result = {}
+    offset = 0
+
+    while offset + 4 <= len(data):
+        length, attr_type = struct.unpack_from("=HH", data, offset)
+
+        if length < 4:
+            break
+
+        result[attr_type] = data[offset + 4:offset + length]
+        offset += (length + 3) & ~3
+
+    return result
+
+
+def parse_addr_dump(data: bytes) -> list:
+    """
+    This function parses the RTM_GETADDR dump to the list of addresses
+    """
+    result = []
+
+    for msg_type, body in iter_messages(data):
+        if msg_type != RTM_NEWADDR:
+            continue
+
+        family, prefixlen, _, scope, index = struct.unpack_from("=BBBBI", body)
+        attrs = parse_attributes(body[8:])
+        raw_ip = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+
+        if raw_ip:
+            result.append({"index": index, "family": 4 if family == socket.AF_INET else 6, "scope": scope,
+                           "ip": str(ipaddress.ip_address(raw_ip)), "prefixlen": prefixlen})
+
+    return result
+
+
+def parse_neigh_dump(data: bytes) -> list:
+    """
+    This function parses the RTM_GETNEIGH dump to the list of neighbors. Incomplete and failed entries are skipped
+    """
+    result = []
+
+    for msg_type, body in iter_messages(data):
+        if msg_type != RTM_NEWNEIGH:
+            continue
+
+        family, _, _, index, state, _, _ = struct.unpack_from("=BBHiHBB", body)
+        attrs = parse_attributes(body[12:])
+
+        if state & (NUD_INCOMPLETE | NUD_FAILED | NUD_NOARP) or NDA_DST not in attrs or NDA_LLADDR not in attrs:
+            continue
+
+        result.append({"index": index, "family": 4 if family == socket.AF_INET else 6,
+                       "ip": str(ipaddress.ip_address(attrs[NDA_DST])),
+                       "mac": "-".join([f"{b:02X}" for b in attrs[NDA_LLADDR]])})
+
+    return result
+
+
+def parse_proc_arp(text: str) -> list:
+    """
+    This function parses /proc/net/arp. Incomplete entries (flags 0x0) are skipped
+    """
+    result = []
+
+    for line in text.splitlines()[1:]:
+        fields = line.split()
+
+        if len(fields) < 6 or fields[2] == "0x0":
+            continue
+
+        result.append({"ip": fields[0], "family": 4, "mac": fields[3].replace(":", "-").upper(),
+                       "interface": fields[5], "hw_type": fields[1]})
+
+    return result
+
+
+def parse_if_inet6(text: str) -> list:
+    """
+    This function parses /proc/net/if_inet6 to the list of IPv6 addresses
+    """
+    result = []
+
+    for line in text.splitlines():
+        fields = line.split()
+
+        if len(fields) < 6:
+            continue
+
+        result.append({"ip": str(ipaddress.ip_address(bytes.fromhex(fields[0]))), "index": int(fields[1], 16),
+                       "prefixlen": int(fields[2], 16), "scope": int(fields[3], 16), "interface": fields[5]})
+
+    return result
+
+
+def neighbor_type(mac: str, hw_type: str = "0x1") -> str:
+    """
+    This function returns the type of the neighbor the same way as the arp parser does
+    """
+    if mac.startswith(("01-", "33-33-")):
+        return "multicast"
+
+    elif mac.startswith("FF-"):
+        return "broadcast"
+
+    return "ethernet" if hw_type == "0x1" else hw_type
+
+
+def get_networks(proc: str = "/proc/net") -> list:
+    """
+    This function collects the IPv4 and IPv6 addresses per interface, excluding loopback and link-local ones
+    """
+    result = {name: {"interface": name, "ipv4": [], "ipv6": []} for _, name in socket.if_nameindex()}
+    names = {index: name for index, name in socket.if_nameindex()}
+
+    for entry in parse_addr_dump(netlink_dump(RTM_GETADDR, socket.AF_INET)):
+        if entry["index"] in names and not entry["ip"].startswith("127."):
+            result[names[entry["index"]]]["ipv4"].append(f"{entry['ip']}/{entry['prefixlen']}")
+
+    if os.path.exists(f"{proc}/if_inet6"):
+        with open(f"{proc}/if_inet6", "r") as f:
+            for entry in parse_if_inet6(f.read()):
+                # Scope 0x10 is host (::1), 0x20 is link
+                if entry["scope"] == 0 and entry["interface"] in result:
+                    result[entry["interface"]]["ipv6"].append(f"{entry['ip']}/{entry['prefixlen']}")
+
+    return list(result.values())
+
+
+def get_neighbors(proc: str = "/proc/net") -> list:
+    """
+    This function collects the IPv4 (ARP) and IPv6 (NDP) neighbors
+    """
+    result = []
+    names = {index: name for index, name in socket.if_nameindex()}
+
+    with open(f"{proc}/arp", "r") as f:
+        for entry in parse_proc_arp(f.read()):
+            result.append({"ip": entry["ip"], "family": 4, "mac": entry["mac"], "interface": entry["interface"],
+                           "type": neighbor_type(entry["mac"], entry["hw_type"])})
+
+    for entry in parse_neigh_dump(netlink_dump(RTM_GETNEIGH, socket.AF_INET6)):
+        result.append({"ip": entry["ip"], "family": 6, "mac": entry["mac"], "interface": names.get(entry["index"]),
+                       "type": neighbor_type(entry["mac"])})
+
+    return result
@@ -0,0 +1,168 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module contains the streaming writer of the results shared across the tools. Each record is written
+as soon as it is known in NDJSON or CSV to stdout (so it can be piped) or to the file, which is optionally
+compressed with gzip or zstd and rotated by size.
+"""
+
+# Modules
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+
+# Local modules
+import helpers.shared as hs
+
+# Lazy modules
+zstandard = hs.lazy_import("zstandard")
+
+# Variables
+formats = ["ndjson", "csv"]
+compressions = {"gzip": ".gz", "zstd": ".zst"}
+
+
+# Classes
+class RecordWriter:
+    """
+    This class writes the records one by one. The file is rotated, once it exceeds rotate_mb of the uncompressed data:
+    results.ndjson.gz, results.1.ndjson.gz, results.2.ndjson.gz, etc. The CSV columns are set by fields or by the first record
+    and the other keys are not written, hence the tools pass the fields for the records of different kinds.
+    """
+    def __init__(self, path: str = "-", fmt: str = "ndjson", fields: list = None, compress: str = "", rotate_mb: float = 0):
+        if fmt not in formats:
+            sys.exit(f"Wrong output format. Must be {', '.join(formats)}")
+
+        if compress and compress not in compressions:
+            sys.exit(f"Wrong compression. Must be {', '.join(compressions)}")
+
+        # The compression may be set by the extension of the file
+        if not compress:
+            compress = next((name for name, ext in compressions.items() if path.endswith(ext)), "")
+
+        self.path = path
+        self.fmt = fmt
+        self.fields = fields
+        self.compress = compress if path != "-" else ""
+        self.rotate = int(rotate_mb * 1048576) if path != "-" else 0
+        self.records = 0
+        self.files = []
+
+        self._stream = None
+        self._owns_stream = False
+        self._raw = None
+        self._csv = None
+        self._buffer = io.StringIO()
+        self._written = 0
+
+        self._open()
+
+    def _open(self) -> None:
+        """
+        This method opens the next file of the rotation
+        """
+        # The stream is taken at start, so the tool may redirect its own messages to stderr. It is never closed by the writer
+        self._owns_stream = self.path != "-"
+
+        if self.path == "-":
+            self._stream = sys.stdout
+
+        else:
+            # The index of the rotated file goes before the extension and the compression suffix: results.1.ndjson.gz
+            suffix = compressions[self.compress] if self.compress else ""
+            base, ext = os.path.splitext(self.path[:-len(suffix)] if suffix and self.path.endswith(suffix) else self.path)
+            path = f"{base}.{len(self.files)}{ext}{suffix}" if self.files else f"{base}{ext}{suffix}"
+
+            rdir = os.path.dirname(path)
+            if rdir and not os.path.exists(rdir):
+                os.makedirs(rdir)
+
+            if self.compress == "gzip":
+                self._raw = gzip.open(path, "wb")
+
+            elif self.compress == "zstd":
+                try:
+                    self._raw = zstandard.ZstdCompressor().stream_writer(open(path, "wb"), closefd=True)
+
+                except ModuleNotFoundError:
+                    sys.exit("The zstd compression requires the zstandard module: pip install zstandard")
+
+            else:
+                self._raw = open(path, "wb")
+
+            self._stream = io.TextIOWrapper(self._raw, encoding="utf-8", newline="")
+            self.files.append(path)
+
+        self._csv = None
+        self._written = 0
+
+    def write(self, record: dict) -> None:
+        """
+        This method writes the record. The nested values are JSON-encoded in CSV
+        """
+        if self.rotate and self._written >= self.rotate:
+            self._close_file()
+            self._open()
+
+        if self.fmt == "csv":
+            # The header is repeated at the top of each rotated file
+            if not self._csv:
+                self.fields = self.fields if self.fields else list(record.keys())
+                self._csv = csv.DictWriter(self._buffer, fieldnames=self.fields, extrasaction="ignore", lineterminator="\n")
+                self._csv.writeheader()
+
+            self._csv.writerow({k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in record.items()})
+            line = self._buffer.getvalue()
+            self._buffer.seek(0)
+            self._buffer.truncate()
+
+        else:
+            line = json.dumps(record, separators=(",", ":")) + "\n"
+
+        self._stream.write(line)
+        self._written += len(line)
+
+        self.records += 1
+
+        # The consumers of the pipe get the record at once
+        if self.path == "-":
+            self._stream.flush()
+
+    def _close_file(self) -> None:
+        if self._owns_stream:
+            self._stream.close()
+
+        else:
+            self._stream.flush()
+
+    def close(self) -> None:
+        self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# User-defined functions
+def add_arguments(parser, default_output: str = "-") -> None:
+    """
+    This function adds the output arguments shared across the tools to the parser
+    """
+    parser.add_argument("--output", dest="output", type=str, default=default_output,
+                        help="Provide the output file or - for stdout." + (f" By default {default_output}." if default_output else ""))
+    parser.add_argument("--compress", dest="compress", type=str, default="",
+                        help=f"Provide the compression of the output file. Options: {', '.join(compressions)}.")
+    parser.add_argument("--rotate", dest="rotate", type=float, default=0,
+                        help="Provide the size in MB of uncompressed data, after which the output file is rotated.")
+
+
+def open_writer(args, fields: list = None) -> RecordWriter:
+    """
+    This function opens the writer from the parsed arguments
+    """
+    return RecordWriter(path=args.output, fmt=args.format, fields=fields, compress=args.compress, rotate_mb=args.rotate)
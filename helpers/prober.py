@@ -0,0 +1,300 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module contains the native asyncio prober, which is used as an alternative to fping.
+The reachability is checked with unprivileged ICMP datagram sockets where the OS allows that
+(see net.ipv4.ping_group_range on Linux) and with the TCP connect otherwise.
+"""
+
+# Modules
+import asyncio
+import socket
+import ipaddress
+import time
+import random
+
+
+# Classes
+class Prober:
+    """
+    This class runs thousands of probes in flight within a single event loop
+    """
+    def __init__(self, timeout: float = 1.0, rate: int = 1000, count: int = 2,
+                 tcp_port: int = 80, max_inflight: int = 1024, min_timeout: float = 0.1):
+        self.timeout = timeout
+        self.rate = rate
+        self.count = count
+        self.tcp_port = tcp_port
+        self.max_inflight = max_inflight
+        self.min_timeout = min_timeout
+
+        self._sockets = {}
+        self._pending = {}
+        self._seq = 0
+        self._next_slot = 0.0
+        self._semaphore = None
+        self._loop = None
+
+    def _get_socket(self, version: int):
+        """
+        This function opens the shared ICMP datagram socket per address family once
+        """
+        if version not in self._sockets:
+            family, proto = (socket.AF_INET, socket.IPPROTO_ICMP) if version == 4 else (socket.AF_INET6, socket.IPPROTO_ICMPV6)
+
+            try:
+                sock = socket.socket(family, socket.SOCK_DGRAM, proto)
+                sock.setblocking(False)
+                self._loop = asyncio.get_running_loop()
+                self._loop.add_reader(sock.fileno(), self._on_reply, sock)
+
+            except OSError:
+                sock = None
+
+            self._sockets[version] = sock
+
+        return self._sockets[version]
+
+    def _on_reply(self, sock) -> None:
+        """
+        This function matches the received ICMP echo reply with the pending probe
+        """
+        try:
+            data, addr = sock.recvfrom(2048)
+
+        except OSError:
+            return
+
+        # Stripping the IPv4 header, if the OS provides it (e.g., MAC OS)
+        if data and data[0] >> 4 == 4:
+            data = data[(data[0] & 0x0F) * 4:]
+
+        if len(data) < 8 or data[0] not in {0, 129}:
+            return
+
+        key = (ipaddress.ip_address(addr[0].split("%")[0]).compressed, int.from_bytes(data[6:8], "big"))
+        future = self._pending.pop(key, None)
+
+        if future and not future.done():
+            future.set_result(time.perf_counter())
+
+    async def _pace(self) -> None:
+        """
+        This function keeps the probes within the packets-per-second budget
+        """
+        now = time.perf_counter()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / self.rate
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _adaptive_timeout(self, estimate: dict) -> float:
+        """
+        This function returns the timeout from the RTT estimate (RFC 6298 style), bounded by the configured one
+        """
+        if not estimate:
+            return self.timeout
+
+        return min(self.timeout, max(self.min_timeout, 2 * (estimate["srtt"] + 4 * estimate["rttvar"])))
+
+    def _update_rtt(self, estimate: dict, rtt: float) -> None:
+        """
+        This function updates the smoothed RTT and its variation with the new sample in seconds
+        """
+        if not estimate:
+            estimate.update({"srtt": rtt, "rttvar": rtt / 2})
+
+        else:
+            estimate["rttvar"] = 0.75 * estimate["rttvar"] + 0.25 * abs(estimate["srtt"] - rtt)
+            estimate["srtt"] = 0.875 * estimate["srtt"] + 0.125 * rtt
+
+    async def _icmp_once(self, sock, ip: str, version: int, timeout: float):
+        """
+        This function sends a single ICMP echo request and returns the RTT in ms or None
+        """
+        self._seq = (self._seq + 1) & 0xFFFF
+        seq = self._seq
+
+        packet = build_echo_request(seq=seq, version=version)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[(ip, seq)] = future
+
+        t1 = time.perf_counter()
+        try:
+            sock.sendto(packet, (ip, 0))
+            t2 = await asyncio.wait_for(future, timeout)
+
+            return (t2 - t1) * 1000
+
+        except (asyncio.TimeoutError, OSError):
+            return None
+
+        finally:
+            self._pending.pop((ip, seq), None)
+
+    async def _tcp_once(self, ip: str, timeout: float):
+        """
+        This function does a single TCP connect and returns the RTT in ms or None.
+        Both the established connection and the refused one (TCP RST) mean the host is alive
+        """
+        t1 = time.perf_counter()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, self.tcp_port), timeout)
+            writer.close()
+
+        except ConnectionRefusedError:
+            pass
+
+        except (asyncio.TimeoutError, OSError):
+            return None
+
+        return (time.perf_counter() - t1) * 1000
+
+    async def probe(self, target: str) -> dict:
+        """
+        This function checks the reachability of a single host
+        """
+        ip = ipaddress.ip_address(target.split("%")[0])
+
+        if not self._semaphore:
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+
+        async with self._semaphore:
+            for attempt in range(1, self.count + 1):
+                await self._pace()
+
+                rtt, method = await self._probe_once(ip, self.timeout)
+
+                if rtt is not None:
+                    break
+
+        return {"ip": ip.compressed, "alive": rtt is not None, "rtt": round(rtt, 3) if rtt is not None else None,
+                "method": method, "attempts": attempt}
+
+    def get_method(self, version: int) -> str:
+        """
+        This function returns the probe method used for the address family: icmp or tcp, if ICMP sockets aren't permitted
+        """
+        return "icmp" if self._get_socket(version) else "tcp"
+
+    async def _probe_once(self, ip, timeout: float) -> tuple:
+        """
+        This function sends a single probe using ICMP, if possible, or TCP otherwise
+        """
+        sock = self._get_socket(ip.version)
+
+        if sock:
+            return await self._icmp_once(sock, ip.compressed, ip.version, timeout), "icmp"
+
+        return await self._tcp_once(ip.compressed, timeout), "tcp"
+
+    async def ping(self, target: str, count: int = 20, interval: float = 0.1) -> list:
+        """
+        This function sends the series of probes to the target at the fixed interval without waiting for replies
+        (similar to ping) and returns RTTs in ms, None for the lost ones
+        """
+        ip = ipaddress.ip_address(target.split("%")[0])
+
+        async def probe_scheduled(seq: int):
+            await asyncio.sleep(seq * interval)
+            await self._pace()
+
+            rtt, _ = await self._probe_once(ip, self.timeout)
+
+            return rtt
+
+        return list(await asyncio.gather(*[probe_scheduled(seq) for seq in range(count)]))
+
+    async def adaptive_sweep(self, targets: list, on_alive=None) -> list:
+        """
+        This function probes the targets in randomized order. The timeout is tightened based on RTTs of the early replies
+        within the same /24 (/64 for IPv6), so a fast LAN doesn't shorten the timeout for the remote hosts. Only the targets,
+        which didn't answer, are retried with the configured timeout. Each live host is reported via on_alive as soon as found
+        """
+        order = list(dict.fromkeys(targets))
+        random.shuffle(order)
+
+        results = {target: {"ip": ipaddress.ip_address(target.split("%")[0]).compressed, "alive": False, "rtt": None,
+                            "method": None, "attempts": 0} for target in order}
+
+        if not self._semaphore:
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+
+        # RTT estimate per /24 or /64
+        estimates = {}
+
+        async def probe_adaptive(target: str, retry: bool) -> None:
+            ip = ipaddress.ip_address(target.split("%")[0])
+            estimate = estimates.setdefault(ipaddress.ip_network(f"{ip}/{24 if ip.version == 4 else 64}", strict=False), {})
+
+            async with self._semaphore:
+                await self._pace()
+
+                rtt, method = await self._probe_once(ip, self.timeout if retry else self._adaptive_timeout(estimate))
+                results[target].update({"method": method, "attempts": results[target]["attempts"] + 1})
+
+                if rtt is not None:
+                    self._update_rtt(estimate, rtt / 1000)
+                    results[target].update({"alive": True, "rtt": round(rtt, 3)})
+
+                    if on_alive:
+                        on_alive(results[target])
+
+        pending = order
+        for attempt in range(self.count):
+            await asyncio.gather(*[probe_adaptive(target, attempt > 0) for target in pending])
+            pending = [target for target in pending if not results[target]["alive"]]
+
+            if not pending:
+                break
+
+        return [results[target] for target in targets]
+
+    async def sweep(self, targets: list) -> list:
+        """
+        This function probes all the targets concurrently and returns results in the order of targets
+        """
+        return await asyncio.gather(*[self.probe(target) for target in targets])
+
+    def close(self) -> None:
+        """
+        This function releases the ICMP sockets
+        """
+        for sock in self._sockets.values():
+            if sock:
+                if self._loop and not self._loop.is_closed():
+                    self._loop.remove_reader(sock.fileno())
+
+                sock.close()
+
+        self._sockets = {}
+
+
+# User-defined functions
+def build_echo_request(seq: int, version: int = 4, payload: bytes = b"automated-troubleshooting") -> bytes:
+    """
+    This function builds the ICMP/ICMPv6 echo request. The identifier is set by the kernel for datagram sockets
+    """
+    header = bytes([8 if version == 4 else 128, 0, 0, 0, 0, 0]) + seq.to_bytes(2, "big")
+
+    # The ICMPv6 checksum is always computed by the kernel
+    if version == 4:
+        checksum = icmp_checksum(header + payload)
+        header = header[:2] + checksum.to_bytes(2, "big") + header[4:]
+
+    return header + payload
+
+
+def icmp_checksum(data: bytes) -> int:
+    """
+    This function computes the Internet checksum (RFC 1071)
+    """
+    if len(data) % 2:
+        data += b"\x00"
+
+    total = sum(int.from_bytes(data[i:i + 2], "big") for i in range(0, len(data), 2))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+
+    return ~total & 0xFFFF
@@ -1,20 +1,506 @@
 #(c)2019-2021, karneliuk.com
 
 """
-This module contains the functions shared across multiple tools.
+This module contains the functions shared across multiple tools: the lazy loading of heavy modules,
+the cached configuration, HTTP helpers, the timing and metrics instrumentation and the startup benchmark of the tools.
 """
 
 # Modules
-import yaml
 import sys
+import ipaddress
+import importlib
+import os
+import stat
+import json
+import time
+import hashlib
+import subprocess
+import statistics
+import threading
+import contextlib
+import atexit
+import tempfile
+import datetime
+import functools
+
+
+# Classes
+class LazyModule:
+    """
+    This class imports the module on the first access to its attribute, so the tools don't pay
+    for the heavy dependencies they don't use in the current run
+    """
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attr)
+
+
+class Metrics:
+    """
+    This class collects the spans (time per stage, e.g. exec, parse, enrich, render) and counters (e.g. cache hits,
+    HTTP requests) of the run. They are exported as JSON logs (the line per span and the summary at exit)
+    or as the Prometheus text file for the node_exporter textfile collector, as set by METRICS_FORMAT (json or
+    prometheus) and METRICS_PATH (the file for JSON logs, stderr by default, or the directory for Prometheus)
+    """
+    def __init__(self, tool: str, fmt: str = "", path: str = ""):
+        self.tool = tool
+        self.fmt = fmt
+        self.path = path
+        self.started = time.time()
+        self.spans = {}
+        self.counters = {}
+
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **labels):
+        """
+        This method measures the stage within the with block
+        """
+        t1 = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            self.record(name, time.perf_counter() - t1, **labels)
+
+    def record(self, name: str, duration: float, **labels) -> None:
+        """
+        This method adds the span measured elsewhere, e.g. the phases of the HTTP request
+        """
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            entry = self.spans.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+
+        if self.fmt == "json":
+            self._log({"event": "span", "span": name, **labels, "duration_ms": round(duration * 1000, 3)})
+
+    def timed(self, name: str, **labels):
+        """
+        This method returns the decorator, which measures each call of the function as the span
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name, **labels):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        """
+        This method increments the counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self) -> dict:
+        with self._lock:
+            spans, counters = sorted(self.spans.items(), key=str), sorted(self.counters.items(), key=str)
+
+        return {"spans": [{"span": name, **dict(labels), "calls": calls, "duration_ms": round(total * 1000, 3)}
+                          for (name, labels), (calls, total) in spans],
+                "counters": [{"counter": name, **dict(labels), "value": value} for (name, labels), value in counters],
+                "duration_ms": round((time.time() - self.started) * 1000, 3)}
+
+    def export(self) -> None:
+        """
+        This method writes the summary in the chosen format. It is called at exit
+        """
+        if self.fmt == "json":
+            self._log({"event": "summary", **self.summary()})
+
+        elif self.fmt == "prometheus":
+            self._write_prometheus()
+
+    def _log(self, entry: dict) -> None:
+        line = json.dumps({"ts": datetime.datetime.now().isoformat(timespec="milliseconds"), "tool": self.tool, **entry})
+
+        with self._lock:
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(line + "\n")
+
+            else:
+                print(line, file=sys.stderr)
+
+    def _write_prometheus(self) -> None:
+        def labels(*pairs) -> str:
+            escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in (("tool", self.tool),) + pairs]
+
+            return ",".join(f'{k}="{v}"' for k, v in escaped)
+
+        # The concurrent jobs of probe_daemon export one after another, so the latest snapshot is published last
+        with self._export_lock:
+            with self._lock:
+                spans, counters = sorted(self.spans.items(), key=str), sorted(self.counters.items(), key=str)
+
+            # The spans and counters are totals since the start: the whole run for the CLI tools, the uptime for probe_daemon
+            lines = ["# HELP troubleshooting_span_seconds Total time spent in the stage since the tool started.",
+                     "# TYPE troubleshooting_span_seconds gauge"]
+            lines += [f"troubleshooting_span_seconds{{{labels(('span', name), *pairs)}}} {round(total, 6)}"
+                      for (name, pairs), (_, total) in spans]
+
+            lines += ["# HELP troubleshooting_span_calls Total times the stage was run since the tool started.",
+                      "# TYPE troubleshooting_span_calls gauge"]
+            lines += [f"troubleshooting_span_calls{{{labels(('span', name), *pairs)}}} {calls}"
+                      for (name, pairs), (calls, _) in spans]
+
+            lines += ["# HELP troubleshooting_events Total events counted since the tool started.",
+                      "# TYPE troubleshooting_events gauge"]
+            lines += [f"troubleshooting_events{{{labels(('counter', name), *pairs)}}} {value}"
+                      for (name, pairs), value in counters]
+
+            lines += ["# HELP troubleshooting_run_seconds Time since the tool started (the duration of the run for the CLI tools).",
+                      "# TYPE troubleshooting_run_seconds gauge",
+                      f"troubleshooting_run_seconds{{{labels()}}} {round(time.time() - self.started, 6)}",
+                      "# HELP troubleshooting_last_run_timestamp_seconds Time of the last export.",
+                      "# TYPE troubleshooting_last_run_timestamp_seconds gauge",
+                      f"troubleshooting_last_run_timestamp_seconds{{{labels()}}} {round(time.time(), 3)}"]
+
+            # The textfile collector must never see the partially written file, the temporary file is unique per process
+            rdir = self.path if self.path else "."
+            os.makedirs(rdir, exist_ok=True)
+
+            fd, tmp = tempfile.mkstemp(prefix=f".{self.tool}.", suffix=".prom.tmp", dir=rdir)
+
+            try:
+                with open(fd, "w") as f:
+                    f.write("\n".join(lines) + "\n")
+
+                # The collector usually runs as another user
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, os.path.join(rdir, f"{self.tool}.prom"))
+
+            except OSError:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+                raise
+
 
 # Used-defined functions
+def lazy_import(name: str):
+    """
+    This function returns the module, which is loaded on the first use
+    """
+    return sys.modules[name] if name in sys.modules else LazyModule(name)
+
+
+# Lazy modules
+yaml = lazy_import("yaml")
+requests = lazy_import("requests")
+
+# Variables
+_configs = {}
+metrics = Metrics(tool=os.path.splitext(os.path.basename(sys.argv[0]))[0] or "python",
+                  fmt=os.environ.get("METRICS_FORMAT", ""), path=os.environ.get("METRICS_PATH", ""))
+atexit.register(metrics.export)
+
+
 def import_config(path: str):
+    """
+    This function returns the parsed configuration. The result is cached in memory and on disk next to the file
+    (as JSON keyed by the file size and mtime), so YAML is parsed only when the file changes. The cache holds
+    the tokens of the configuration, hence it has the same permissions as the file
+    """
     try:
-        with open(path, "r") as f:
-            result = yaml.load(f.read(), Loader=yaml.FullLoader)
-        return result
-        
+        st = os.stat(path)
+
     except FileNotFoundError:
         sys.exit(f"The configuration file {path} cannot be found. Check if it exists in your folder.")
 
+    fingerprint = [st.st_size, st.st_mtime_ns]
+    mode = stat.S_IMODE(st.st_mode)
+    cache_file = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.json")
+
+    if path in _configs and _configs[path]["fingerprint"] == fingerprint:
+        return _configs[path]["config"]
+
+    try:
+        with open(cache_file, "r") as f:
+            cached = json.load(f)
+
+    except (OSError, json.decoder.JSONDecodeError):
+        cached = {}
+
+    if cached.get("fingerprint") != fingerprint:
+        with open(path, "r") as f:
+            cached = {"fingerprint": fingerprint, "config": yaml.load(f.read(), Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))}
+
+        # The cache is optional, e.g. the folder may be read-only
+        try:
+            write_json(cache_file, cached, mode=mode)
+
+        except (OSError, TypeError, ValueError):
+            pass
+
+    # The cache written by the earlier versions may be readable by others
+    elif stat.S_IMODE(os.stat(cache_file).st_mode) != mode:
+        try:
+            os.chmod(cache_file, mode)
+
+        except OSError:
+            pass
+
+    _configs[path] = cached
+
+    return cached["config"]
+
+
+def get_session(pool_size: int = 10):
+    """
+    This function returns the HTTP session with the keep-alive connection pool
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    # Counting the HTTP requests per host and status
+    session.hooks["response"].append(lambda response, *args, **kwargs: metrics.count(
+        "http_requests", host=response.url.split("/")[2], status=response.status_code))
+
+    return session
+
+
+def is_public_ip(host: str) -> bool:
+    """
+    This function checks if the host is a valid globally routable IP address (neither private nor bogon)
+    """
+    try:
+        return ipaddress.ip_address(host).is_global
+
+    except ValueError:
+        return False
+
+
+def fetch_file(url: str, rdir: str, max_age: int = 604800, session=None, validate=None) -> str:
+    """
+    This function keeps the local copy of the file from the URL and returns its path. Once the copy is older than
+    max_age, it is revalidated with ETag/If-Modified-Since. The download is streamed to the temporary file, resumed
+    if it was interrupted and renamed atomically after the integrity check (size and optional validate(path)).
+    The stale copy is revalidated only if its SHA-256 still matches, otherwise it is downloaded again
+    """
+    # Local vars
+    path = f"{rdir}/{url.split('/')[-1]}"
+    part = f"{path}.part"
+    meta_file = f"{path}.meta"
+
+    if not os.path.exists(rdir):
+        os.makedirs(rdir)
+
+    meta = {}
+    if os.path.exists(meta_file):
+        with open(meta_file, "r") as f:
+            meta = json.load(f)
+
+    local_ok = os.path.exists(path) and os.path.getsize(path) == meta.get("size", os.path.getsize(path))
+
+    if local_ok and time.time() - meta.get("fetched", 0) < max_age:
+        print(f"The file '{path}' already exists. Using local copy...")
+        return path
+
+    # The stale copy is revalidated only if it is intact, otherwise the server could confirm the corrupted file
+    if local_ok and meta.get("sha256"):
+        local_ok = get_sha256(path) == meta["sha256"]
+
+    # Revalidating the local copy and resuming the partial download, if any
+    headers = {"Accept-Encoding": "identity"}
+    if local_ok:
+        headers.update({"If-None-Match": meta["etag"]} if meta.get("etag") else {})
+        headers.update({"If-Modified-Since": meta["last_modified"]} if meta.get("last_modified") else {})
+
+    offset = os.path.getsize(part) if os.path.exists(part) and meta.get("part_validator") else 0
+    if offset:
+        headers.update({"Range": f"bytes={offset}-", "If-Range": meta["part_validator"]})
+
+    print(f"The file '{path}' is {'stale' if local_ok else 'missing'}. Downloading{' (resuming)' if offset else ''}...")
+
+    try:
+        with (session if session else get_session(pool_size=1)).get(url=url, headers=headers, stream=True, timeout=30) as response:
+            if response.status_code == 304:
+                print(f"The file '{path}' is not modified. Using local copy...")
+
+                # The partial download is of no use, once the local copy is confirmed
+                if os.path.exists(part):
+                    os.remove(part)
+
+                meta.pop("part_validator", None)
+                meta.update({"fetched": time.time()})
+                write_json(meta_file, meta)
+
+                return path
+
+            # The part may hold the whole file already, e.g. if the process was stopped before the rename
+            if response.status_code == 416 and offset:
+                print(f"The partial download of '{path}' cannot be resumed. Downloading again...")
+                os.remove(part)
+                meta.pop("part_validator", None)
+                write_json(meta_file, meta)
+
+                return fetch_file(url=url, rdir=rdir, max_age=max_age, session=session, validate=validate)
+
+            response.raise_for_status()
+
+            # The server may ignore the range and send the whole file, e.g. if the validator has changed
+            if response.status_code != 206:
+                offset = 0
+
+                if os.path.exists(part):
+                    os.remove(part)
+
+            # Remembering the validator to resume the interrupted download later
+            meta.update({"part_validator": response.headers.get("ETag", response.headers.get("Last-Modified"))})
+            write_json(meta_file, meta)
+
+            with open(part, "ab" if offset else "wb") as f:
+                for chunk in response.iter_content(chunk_size=65536):
+                    f.write(chunk)
+
+            expected = int(response.headers["Content-Length"]) + offset if "Content-Length" in response.headers else None
+
+    except requests.exceptions.RequestException as e:
+        if local_ok:
+            print(f"The file '{path}' cannot be refreshed ({e}). Using local copy...")
+            return path
+
+        sys.exit(f"The file {url} cannot be downloaded: {e}")
+
+    # Checking the integrity before replacing the local copy
+    if (expected is not None and os.path.getsize(part) != expected) or (validate and not validate(part)):
+        os.remove(part)
+
+        if local_ok:
+            print(f"The downloaded file '{path}' is corrupted. Using local copy...")
+            return path
+
+        sys.exit(f"The downloaded file {url} is corrupted.")
+
+    digest = get_sha256(part)
+
+    os.replace(part, path)
+    write_json(meta_file, {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified"),
+                           "fetched": time.time(), "size": os.path.getsize(path), "sha256": digest})
+
+    return path
+
+
+def get_sha256(path: str) -> str:
+    """
+    This function returns the SHA-256 digest of the file
+    """
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def write_json(path: str, data, mode: int = None) -> None:
+    """
+    This function writes the JSON file atomically, optionally with the provided permissions
+    """
+    if mode is not None:
+        fd = os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        os.fchmod(fd, mode)
+
+    with open(fd if mode is not None else f"{path}.tmp", "w") as f:
+        json.dump(data, f)
+
+    os.replace(f"{path}.tmp", path)
+
+
+def benchmark_startup(tools: list, runs: int = 5) -> dict:
+    """
+    This function measures the startup of each tool (import without running the body) in a fresh interpreter:
+    the wall time and the import time of the top-level modules reported by -X importtime, medians in ms
+    """
+    result = {}
+
+    for tool in tools:
+        module = os.path.splitext(os.path.basename(tool))[0]
+        wall, imports = [], []
+
+        for _ in range(runs):
+            t1 = time.perf_counter()
+            proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True,
+                                  stdin=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(tool)))
+            wall.append((time.perf_counter() - t1) * 1000)
+
+            if proc.returncode:
+                break
+
+            # Top-level imports have a single space before the module name
+            cumulative = 0
+            for line in proc.stderr.decode("utf-8").splitlines():
+                fields = line.split("|")
+
+                if line.startswith("import time:") and len(fields) == 3 and fields[1].strip().isdigit() and fields[2][1:2] != " ":
+                    cumulative += int(fields[1])
+
+            imports.append(cumulative / 1000)
+
+        result[tool] = {"wall_ms": round(statistics.median(wall), 1), "import_ms": round(statistics.median(imports), 1) if imports else None,
+                        "error": proc.stderr.decode("utf-8").splitlines()[-1] if proc.returncode else None}
+
+    return result
+
+
+# Body
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of the tools and catch regressions.")
+
+    parser.add_argument("tools", nargs="+",
+                        help="Provide the tools to benchmark, e.g. get_nodes.py trace_analyzer.py.")
+    parser.add_argument("--runs", dest="runs", type=int, default=5,
+                        help="Provide the amount of runs per tool.")
+    parser.add_argument("--baseline", dest="baseline", type=str, default="./.startup_baseline.json",
+                        help="Provide the file with the baseline results.")
+    parser.add_argument("--save", action="store_true",
+                        help="Specify if you want to save the results as the new baseline.")
+    parser.add_argument("--threshold", dest="threshold", type=float, default=20,
+                        help="Provide the allowed regression of the import time in percent.")
+
+    args = parser.parse_args()
+    results = benchmark_startup(args.tools, args.runs)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    regressions = []
+    for tool, entry in results.items():
+        base = baseline.get(tool, {}).get("import_ms")
+        print(f"{tool}: wall {entry['wall_ms']} ms, imports {entry['import_ms']} ms" + (f" (baseline {base} ms)" if base else "") +
+              (f", error: {entry['error']}" if entry["error"] else ""))
+
+        if base and entry["import_ms"] and entry["import_ms"] > base * (1 + args.threshold / 100):
+            regressions.append(tool)
+
+    if args.save:
+        write_json(args.baseline, results)
+
+    if regressions:
+        sys.exit(f"Startup regression beyond {args.threshold}%: {', '.join(regressions)}")
@@ -0,0 +1,168 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module contains the append-only columnar store for the iperf3 results.
+Each column is kept as the flat array of doubles per server, table and day:
+  <root>/<server>/<table>/<YYYY-MM-DD>/<column>.f64
+so that months of results are loaded as arrays without parsing the JSON reports.
+"""
+
+# Modules
+import array
+import bisect
+import datetime
+import math
+import operator
+import os
+
+
+# Variables
+tables = {
+    "intervals": ("ts", "bits_per_second", "retransmits", "rtt"),
+    "summary": ("ts", "sent_bps", "received_bps", "retransmits", "rtt")
+}
+
+
+# User-defined functions
+def parse_iperf3(result: dict) -> dict:
+    """
+    This function extracts the per-interval and summary metrics from the iperf3 JSON output.
+    RTT is in ms, retransmits and RTT are NaN, if iperf3 doesn't report them (e.g., UDP or MAC OS)
+    """
+    nan = float("nan")
+    started = result["start"]["timestamp"]["timesecs"]
+
+    intervals = []
+    for entry in result.get("intervals", []):
+        rtts = [s["rtt"] / 1000 for s in entry.get("streams", []) if "rtt" in s]
+
+        intervals.append((started + entry["sum"]["start"], entry["sum"]["bits_per_second"],
+                          entry["sum"].get("retransmits", nan), sum(rtts) / len(rtts) if rtts else nan))
+
+    end = result.get("end", {})
+    sent = end.get("sum_sent", end.get("sum", {}))
+    received = end.get("sum_received", end.get("sum", {}))
+    rtts = [s["sender"]["mean_rtt"] / 1000 for s in end.get("streams", []) if "mean_rtt" in s.get("sender", {})]
+
+    summary = [(started, sent.get("bits_per_second", nan), received.get("bits_per_second", nan),
+                sent.get("retransmits", nan), sum(rtts) / len(rtts) if rtts else nan)]
+
+    return {"intervals": intervals, "summary": summary}
+
+
+def get_server(result: dict, default: str = "unknown") -> str:
+    """
+    This function returns the iperf3 server the test was run against, safe to be used as the directory name
+    """
+    server = result.get("start", {}).get("connecting_to", {}).get("host", default)
+
+    return server.replace(os.sep, "_")
+
+
+def append(root: str, server: str, metrics: dict) -> None:
+    """
+    This function appends the rows to the daily segments of the store
+    """
+    for table, rows in metrics.items():
+        # Rows are grouped per day of their timestamp
+        days = {}
+        for row in rows:
+            days.setdefault(datetime.datetime.fromtimestamp(row[0]).strftime("%Y-%m-%d"), []).append(row)
+
+        for day, day_rows in days.items():
+            path = os.path.join(root, server, table, day)
+            os.makedirs(path, exist_ok=True)
+            repair(path, tables[table])
+
+            for index, column in enumerate(tables[table]):
+                with open(os.path.join(path, f"{column}.f64"), "ab") as f:
+                    array.array("d", [row[index] for row in day_rows]).tofile(f)
+
+
+def repair(path: str, columns: tuple) -> None:
+    """
+    This function truncates the columns of the segment to the complete rows, if the previous append was interrupted,
+    so that the new rows stay aligned across the columns
+    """
+    itemsize = array.array("d").itemsize
+    files = [os.path.join(path, f"{column}.f64") for column in columns]
+    sizes = [os.path.getsize(filename) if os.path.exists(filename) else 0 for filename in files]
+    size = min(sizes) // itemsize * itemsize
+
+    for filename, current in zip(files, sizes):
+        if current > size:
+            os.truncate(filename, size)
+
+
+def load(root: str, server: str, table: str, since: datetime.datetime = None, until: datetime.datetime = None) -> dict:
+    """
+    This function loads the columns of the table for the time window as arrays. The days within the window are
+    loaded as a whole, while the first and the last day are sliced by the time
+    """
+    result = {column: array.array("d") for column in tables[table]}
+    path = os.path.join(root, server, table)
+
+    if not os.path.exists(path):
+        return result
+
+    for day in sorted(os.listdir(path)):
+        if (since and day < since.strftime("%Y-%m-%d")) or (until and day > until.strftime("%Y-%m-%d")):
+            continue
+
+        segment = {}
+        for column in tables[table]:
+            segment[column] = array.array("d")
+            filename = os.path.join(path, day, f"{column}.f64")
+
+            if os.path.exists(filename):
+                with open(filename, "rb") as f:
+                    segment[column].fromfile(f, os.path.getsize(filename) // segment[column].itemsize)
+
+        # Ignoring the incomplete row, if the append was interrupted
+        rows = min(len(values) for values in segment.values())
+        ts = segment["ts"][:rows]
+        ts_from = since.timestamp() if since else -math.inf
+        ts_to = until.timestamp() if until else math.inf
+
+        if not ts or (ts_from <= min(ts) and max(ts) <= ts_to):
+            keep = slice(0, rows)
+
+        # The rows of the concurrent tests may be interleaved, then the segment isn't sorted by time
+        elif all(map(operator.le, ts, ts[1:])):
+            keep = slice(bisect.bisect_left(ts, ts_from), bisect.bisect_right(ts, ts_to))
+
+        else:
+            keep = [i for i in range(rows) if ts_from <= ts[i] <= ts_to]
+
+        for column, values in segment.items():
+            result[column].extend(values[keep] if isinstance(keep, slice) else (values[i] for i in keep))
+
+    return result
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    This function returns the q-th percentile with the linear interpolation, NaNs are ignored
+    """
+    values = sorted(v for v in values if not math.isnan(v))
+
+    if not values:
+        return math.nan
+
+    position = (len(values) - 1) * q / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def tumbling(ts: list, values: list, window: int) -> list:
+    """
+    This function returns the mean of values per consecutive, non-overlapping windows of the provided size in seconds
+    """
+    buckets = {}
+    for t, v in zip(ts, values):
+        if not math.isnan(v):
+            buckets.setdefault(int(t // window) * window, []).append(v)
+
+    return [(bucket, sum(vals) / len(vals)) for bucket, vals in sorted(buckets.items())]
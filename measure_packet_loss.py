@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#(c)2019-2021, karneliuk.com
+
+"""
+This tool measures the packet loss, latency and jitter towards the list of destinations.
+All the destinations are probed concurrently, so the measurement takes roughly the same time
+regardless of the amount of targets. It can run once or continuously as a daemon with the rolling window.
+"""
+
+# Modules
+import argparse
+import asyncio
+import collections
+import csv
+import datetime
+import ipaddress
+import json
+import socket
+import sys
+import time
+
+# Local modules
+import helpers.prober as hpr
+import helpers.shared as hs
+import helpers.timeseries as hts
+
+
+# User-defined functions
+def args_parser():
+    """
+    This function contains information about arguments you provide for the script to run
+    """
+    parser = argparse.ArgumentParser(description="Measure the packet loss towards the list of destinations.")
+
+    parser.add_argument("targets", type=str,
+                        help="Provide the file with destinations, one per line.")
+    parser.add_argument("--count", dest="count", type=int, default=20,
+                        help="Provide the amount of probes per destination.")
+    parser.add_argument("--interval", dest="interval", type=float, default=0.1,
+                        help="Provide the interval between probes in seconds.")
+    parser.add_argument("--timeout", dest="timeout", type=float, default=1.0,
+                        help="Provide the probe timeout in seconds.")
+    parser.add_argument("--rate", dest="rate", type=int, default=1000,
+                        help="Provide the overall probing rate in packets per second.")
+    parser.add_argument("--format", dest="format", type=str, default="csv",
+                        help="Provide the output format. Options: csv, json or jsonl.")
+    parser.add_argument("--output", dest="output", type=str, default="results.csv",
+                        help="Provide the output file.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Specify if you want to measure continuously.")
+    parser.add_argument("--period", dest="period", type=float, default=60,
+                        help="Provide the period between measurements in seconds. Works with daemon.")
+    parser.add_argument("--window", dest="window", type=int, default=10,
+                        help="Provide the amount of measurements in the rolling window. Works with daemon.")
+
+    result = parser.parse_args()
+
+    if result.format not in {"csv", "json", "jsonl"}:
+        sys.exit("Wrong output format. Must be csv, json or jsonl")
+
+    if result.count < 1 or result.rate < 1 or result.window < 1:
+        sys.exit("The count, rate and window must be at least 1.")
+
+    return result
+
+
+def load_targets(path: str) -> list:
+    """
+    This function reads the destinations from the file skipping empty lines and comments
+    """
+    try:
+        with open(path, "r") as f:
+            return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+    except FileNotFoundError:
+        sys.exit(f"The targets file {path} cannot be found.")
+
+
+async def resolve(target: str):
+    """
+    This function returns the IP address of the destination or None, if it cannot be resolved
+    """
+    try:
+        return ipaddress.ip_address(target).compressed
+
+    except ValueError:
+        try:
+            return (await asyncio.get_running_loop().getaddrinfo(target, None))[0][4][0]
+
+        except socket.gaierror:
+            return None
+
+
+def get_stats(target: str, rtts: list, method: str = None) -> dict:
+    """
+    This function computes loss, min/avg/max, jitter and percentiles of RTTs in ms
+    """
+    received = [rtt for rtt in rtts if rtt is not None]
+
+    result = {"host_ip": target, "packet_loss": round((len(rtts) - len(received)) / len(rtts) * 100, 2) if rtts else 100.0,
+              "sent": len(rtts), "received": len(received), "min": None, "avg": None, "max": None, "jitter": None,
+              "p50": None, "p90": None, "p99": None, "method": method}
+
+    if received:
+        # Jitter is the mean difference between consecutive RTTs
+        diffs = [abs(b - a) for a, b in zip(received, received[1:])]
+
+        result.update({"min": round(min(received), 3), "avg": round(sum(received) / len(received), 3),
+                       "max": round(max(received), 3), "jitter": round(sum(diffs) / len(diffs), 3) if diffs else 0.0,
+                       "p50": round(hts.percentile(received, 50), 3), "p90": round(hts.percentile(received, 90), 3),
+                       "p99": round(hts.percentile(received, 99), 3)})
+
+    return result
+
+
+async def measure(targets: list, args, methods: dict = None) -> dict:
+    """
+    This function probes all the destinations concurrently and returns RTTs per destination.
+    The probe method per destination (icmp or tcp, if ICMP sockets aren't permitted) is put to methods
+    """
+    prober = hpr.Prober(timeout=args.timeout, rate=args.rate)
+    methods = methods if methods is not None else {}
+
+    async def measure_target(target: str) -> list:
+        ip = await resolve(target)
+
+        if not ip:
+            return [None] * args.count
+
+        methods[target] = prober.get_method(ipaddress.ip_address(ip).version)
+
+        return await prober.ping(ip, count=args.count, interval=args.interval)
+
+    try:
+        with hs.metrics.span("measure"):
+            result = await asyncio.gather(*[measure_target(target) for target in targets])
+
+    finally:
+        prober.close()
+
+    return dict(zip(targets, result))
+
+
+def warn_tcp(methods: dict) -> None:
+    """
+    This function warns, if the destinations are probed with TCP connects, as the hosts not listening on the port look lost
+    """
+    tcp = [target for target, method in methods.items() if method == "tcp"]
+
+    if tcp:
+        print(f"Warning: ICMP sockets are not permitted (see net.ipv4.ping_group_range), {len(tcp)} destinations are probed "
+              f"with TCP connects to port 80 instead. Hosts not answering on it are reported as lost.", file=sys.stderr)
+
+
+def write_results(results: list, args, append: bool = False) -> None:
+    """
+    This function writes the results in the chosen format
+    """
+    if args.format == "json":
+        with open(args.output, "w") as f:
+            f.write(json.dumps(results, indent=4))
+
+    elif args.format == "jsonl":
+        with open(args.output, "a" if append else "w") as f:
+            for entry in results:
+                f.write(json.dumps(entry) + "\n")
+
+    else:
+        with open(args.output, "a" if append else "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+
+            if not append or f.tell() == 0:
+                writer.writeheader()
+
+            writer.writerows(results)
+
+
+# Body
+if __name__ == "__main__":
+    args = args_parser()
+    targets = load_targets(args.targets)
+
+    if not targets:
+        sys.exit("No destinations provided.")
+
+    if not args.daemon:
+        t1 = datetime.datetime.now()
+        print(f"Checking packet loss for {len(targets)} destinations...")
+
+        methods = {}
+        rtts = asyncio.run(measure(targets, args, methods))
+        warn_tcp(methods)
+        write_results([get_stats(target, rtts[target], methods.get(target)) for target in targets], args)
+
+        print(f"Measurement completed in {datetime.datetime.now() - t1}. Results: {args.output}")
+        sys.exit()
+
+    # Daemon mode with the rolling window of measurements per destination
+    windows = {target: collections.deque(maxlen=args.window) for target in targets}
+
+    try:
+        while True:
+            started = time.time()
+            methods = {}
+            rtts = asyncio.run(measure(targets, args, methods))
+            warn_tcp(methods)
+            timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+
+            results = []
+            for target in targets:
+                windows[target].append(rtts[target])
+                results.append({"timestamp": timestamp, **get_stats(target, [rtt for rnd in windows[target] for rtt in rnd], methods.get(target))})
+
+            write_results(results, args, append=args.format != "json")
+            print(f"{timestamp}: measured {len(targets)} destinations in {round(time.time() - started, 2)} s")
+
+            time.sleep(max(0, args.period - (time.time() - started)))
+
+    except KeyboardInterrupt:
+        sys.exit()
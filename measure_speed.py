@@ -6,27 +6,244 @@ import sys
 import json
 import datetime
 import os
+import re
+import argparse
+import time
+import concurrent.futures
+
+# Local modules
+import helpers.timeseries as hts
+import helpers.shared as hs
 
 # Variables
 target_dir = "./reports"
+store_dir = "./timeseries"
+
+
+# User-defined functions
+def run_test(target: dict) -> dict:
+    """
+    This function runs a single iperf3 test and retries with the exponential backoff, if the server is busy
+    """
+    args = ["iperf3", "-c", str(target["server"]), "--json"]
+    args += ["-p", str(target["port"])] if "port" in target else []
+    args += ["-P", str(target["parallel"])] if "parallel" in target else []
+    args += ["-t", str(target["duration"])] if "duration" in target else []
+    args += ["-R"] if target.get("reverse") else []
+    args += ["-u"] if target.get("udp") else []
+    args += ["-b", str(target["bandwidth"])] if "bandwidth" in target else []
+
+    for attempt in range(target.get("retries", 3) + 1):
+        try:
+            with hs.metrics.span("exec", command="iperf3"):
+                result = json.loads(subprocess.run(args, stdout=subprocess.PIPE).stdout.decode('utf-8'))
+
+        except json.decoder.JSONDecodeError:
+            result = {"error": "iperf3 returned no valid output"}
+
+        if "busy" not in result.get("error", ""):
+            break
+
+        hs.metrics.count("server_busy", server=str(target["server"]))
+
+        delay = target.get("backoff", 5) * 2 ** attempt
+        print(f"The server {target['server']} is busy. Retrying in {delay} s...")
+        time.sleep(delay)
+
+    return result
+
+
+@hs.metrics.timed("store")
+def save_result(result: dict, server: str, campaign: bool = False, index: int = 0) -> None:
+    """
+    This function saves the iperf3 report to the reports tree and appends its metrics to the columnar store.
+    The campaign reports have the seconds, the server and the index of the test in the campaign in the filename,
+    as many tests (also to the same server) run within the same minute
+    """
+    day, clock = str(datetime.datetime.now()).split(" ")
+    tl = clock.split(".")[0].split(":")
+    fn = f"results_{tl[0]}:{tl[1]}:{tl[2]}_{hts.get_server(result, server)}_{index}.json" if campaign else f"results_{tl[0]}:{tl[1]}.json"
+
+    if not os.path.exists(target_dir):
+        os.mkdir(target_dir)
+
+    if not os.path.exists(f"{target_dir}/{day}"):
+        os.mkdir(f"{target_dir}/{day}")
+
+    with open(f"{target_dir}/{day}/{fn}", "w") as f:
+        f.write(json.dumps(result, indent=4, sort_keys=True))
+
+    # Appending the metrics to the columnar store
+    if "error" not in result:
+        hts.append(store_dir, hts.get_server(result, server), hts.parse_iperf3(result))
+
+        with open(os.path.join(store_dir, "imported.txt"), "a") as f:
+            f.write(f"{target_dir}/{day}/{fn}\n")
+
+
+def run_campaign(targets: list) -> list:
+    """
+    This function runs the tests of the campaign. Tests sharing the same path (the local uplink by default)
+    run one after another, while tests on independent paths run concurrently
+    """
+    paths = {}
+    for index, target in enumerate(targets):
+        paths.setdefault(target.get("path", "uplink"), []).append((index, target))
+
+    def run_path(path_targets: list) -> list:
+        path_result = []
+
+        for index, target in path_targets:
+            print(f"Testing {target['server']}...")
+            result = run_test(target)
+            save_result(result, str(target["server"]), campaign=True, index=index)
+
+            path_result.append({"server": target["server"], "error": result.get("error")})
+
+        return path_result
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(paths) or 1) as executor:
+        return [entry for path_result in executor.map(run_path, paths.values()) for entry in path_result]
+
+
+def import_reports(rdir: str, sdir: str) -> int:
+    """
+    This function imports the existing JSON reports tree into the columnar store. Each file is imported once
+    """
+    result = 0
+    index_file = os.path.join(sdir, "imported.txt")
+
+    if not os.path.isdir(rdir):
+        sys.exit(f"The reports folder {rdir} doesn't exist. Nothing to import.")
+
+    imported = set()
+    if os.path.exists(index_file):
+        with open(index_file, "r") as f:
+            imported = set(f.read().splitlines())
+
+    os.makedirs(sdir, exist_ok=True)
+
+    with open(index_file, "a") as index:
+        for day in sorted(os.listdir(rdir)):
+            if not re.match(r"^\d{4}-\d{2}-\d{2}$", day):
+                continue
+
+            for fn in sorted(os.listdir(os.path.join(rdir, day))):
+                path = os.path.join(rdir, day, fn)
+
+                if not fn.endswith(".json") or path in imported:
+                    continue
+
+                try:
+                    with open(path, "r") as f:
+                        data = json.load(f)
+
+                    hts.append(sdir, hts.get_server(data), hts.parse_iperf3(data))
+
+                except (json.decoder.JSONDecodeError, KeyError):
+                    print(f"Skipping the broken report {path}...")
+                    continue
+
+                index.write(f"{path}\n")
+                result += 1
+
+    return result
+
+
+def report(args) -> None:
+    """
+    This function prints percentiles and the average throughput per window from the columnar store
+    """
+    since = datetime.datetime.fromisoformat(args.since) if args.since else None
+    until = datetime.datetime.fromisoformat(args.until) if args.until else None
+
+    servers = [args.server] if args.server else sorted(os.listdir(store_dir)) if os.path.exists(store_dir) else []
+
+    for server in servers:
+        if not os.path.isdir(os.path.join(store_dir, server)):
+            continue
+
+        summary = hts.load(store_dir, server, "summary", since, until)
+        intervals = hts.load(store_dir, server, "intervals", since, until)
+
+        print(f"\nServer {server}: {len(summary['ts'])} tests, {len(intervals['ts'])} intervals")
+
+        for name, values in (("received bps", summary["received_bps"]), ("interval bps", intervals["bits_per_second"]),
+                             ("retransmits", summary["retransmits"]), ("rtt ms", summary["rtt"])):
+            print(f"  {name:>13}: " + ", ".join([f"p{q}={hts.percentile(values, q):.2f}" for q in args.percentiles]))
+
+        print(f"  Average throughput per {args.window} s window:")
+        for bucket, value in hts.tumbling(intervals["ts"], intervals["bits_per_second"], args.window):
+            print(f"    {datetime.datetime.fromtimestamp(bucket)}: {value:.0f} bps")
+
+
+def percentiles(value: str) -> list:
+    """
+    This function parses the comma-separated percentiles for argparse
+    """
+    try:
+        result = [int(q) for q in value.split(",")]
+
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"the percentiles must be integers: {value}")
+
+    if any(q < 0 or q > 100 for q in result):
+        raise argparse.ArgumentTypeError(f"the percentiles must be from 0 to 100: {value}")
+
+    return result
+
+
+def report_parser(argv: list):
+    """
+    This function contains information about arguments you provide for the report and import commands
+    """
+    parser = argparse.ArgumentParser(description="Query the iperf3 results from the columnar store.")
+
+    parser.add_argument("command", help="Provide the command. Options: report or import.")
+    parser.add_argument("--server", dest="server", type=str, default="",
+                        help="Provide the iperf3 server. All servers are reported by default.")
+    parser.add_argument("--since", dest="since", type=str, default="",
+                        help="Provide the start of the window in ISO format, e.g. 2021-05-01T00:00.")
+    parser.add_argument("--until", dest="until", type=str, default="",
+                        help="Provide the end of the window in ISO format.")
+    parser.add_argument("--window", dest="window", type=int, default=3600,
+                        help="Provide the window for the average throughput in seconds. The windows don't overlap.")
+    parser.add_argument("--percentiles", dest="percentiles", type=percentiles, default="5,50,95",
+                        help="Provide the comma-separated percentiles from 0 to 100.")
+
+    result = parser.parse_args(argv)
+
+    if result.window < 1:
+        sys.exit("The window must be at least 1 second.")
+
+    return result
+
 
 # Body
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
+    if len(sys.argv) < 2:
         sys.exit("Wrong number of arguments is provided.")
 
-    result = json.loads(subprocess.run(["iperf3", "-c", sys.argv[1], '--json'], stdout=subprocess.PIPE).stdout.decode('utf-8'))
+    if sys.argv[1] == "import":
+        print(f"Imported {import_reports(target_dir, store_dir)} reports from {target_dir}.")
+        sys.exit()
 
-    if result:
-        day, time = str(datetime.datetime.now()).split(" ")
-        tl = time.split(":")
-        fn = f"results_{tl[0]}:{tl[1]}.json"
+    if sys.argv[1] == "campaign":
+        if len(sys.argv) != 3:
+            sys.exit("Provide the campaign file: ./measure_speed.py campaign campaign.yml")
 
-        if not os.path.exists(target_dir):
-            os.mkdir(target_dir)
+        campaign = run_campaign(hs.import_config(sys.argv[2])["targets"])
+        print(f"Campaign completed: {len([e for e in campaign if not e['error']])} of {len(campaign)} tests succeeded.")
+        sys.exit()
 
-        if not os.path.exists(f"{target_dir}/{day}"):
-            os.mkdir(f"{target_dir}/{day}")
+    if sys.argv[1] == "report":
+        report(report_parser(sys.argv[1:]))
+        sys.exit()
 
-        with open(f"{target_dir}/{day}/{fn}", "w") as f:
-            f.write(json.dumps(result, indent=4, sort_keys=True))
+    if len(sys.argv) != 2:
+        sys.exit("Wrong number of arguments is provided.")
+
+    result = run_test({"server": sys.argv[1], "retries": 0})
+
+    if result:
+        save_result(result, sys.argv[1])
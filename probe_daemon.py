@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+#(c)2019-2021, karneliuk.com
+
+"""
+This tool runs the diagnostics of this toolkit as periodic jobs within a single long-running process.
+The interpreter, configuration, HTTP connection pools and caches stay warm across the jobs.
+Jobs are scheduled with jitter, run within the concurrency limit and the exclusive ones (e.g., bandwidth tests)
+never overlap with any other job. The latest results are exposed via the local HTTP status endpoint.
+The jobs are defined in the "daemon" section of config.yml.
+"""
+
+# Modules
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import heapq
+import http.server
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+
+# Local modules
+import helpers.shared as hs
+import helpers.cache as hc
+
+
+# Classes
+class JobLock:
+    """
+    This class lets the shared jobs run together, while the exclusive job runs alone. The waiting exclusive job
+    stops new shared jobs from starting, so it isn't postponed forever by the shared jobs
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    def acquire(self, exclusive: bool) -> None:
+        with self._cond:
+            if exclusive:
+                self._waiting += 1
+
+                try:
+                    self._cond.wait_for(lambda: not self._exclusive and not self._shared)
+
+                finally:
+                    self._waiting -= 1
+
+                self._exclusive = True
+
+            else:
+                self._cond.wait_for(lambda: not self._exclusive and not self._waiting)
+                self._shared += 1
+
+    def release(self, exclusive: bool) -> None:
+        with self._cond:
+            if exclusive:
+                self._exclusive = False
+
+            else:
+                self._shared -= 1
+
+            self._cond.notify_all()
+
+
+# User-defined functions
+def args_parser():
+    """
+    This function contains information about arguments you provide for the script to run
+    """
+    parser = argparse.ArgumentParser(description="Run the diagnostics as periodic jobs in a single process.")
+
+    parser.add_argument("--config", dest="config", type=str, default="./config.yml",
+                        help="Provide the configuration file with the daemon section.")
+
+    return parser.parse_args()
+
+
+def job_public_ip(job: dict, context: dict) -> dict:
+    """
+    This function resolves the public IP over the warm connection pool
+    """
+    response = context["session"].get(url=context["config"]["urls"]["geo_ip"], timeout=job.get("timeout", 5))
+    response.raise_for_status()
+
+    return response.json()
+
+
+def job_speedtest(job: dict, context: dict) -> dict:
+    """
+    This function runs the Ookla SpeedTest CLI
+    """
+    result = json.loads(subprocess.run(["speedtest", "-f", "json"], capture_output=True).stdout.decode("utf-8"))
+
+    return {"download_bps": result["download"]["bandwidth"] * 8, "upload_bps": result["upload"]["bandwidth"] * 8}
+
+
+def job_iperf3(job: dict, context: dict) -> dict:
+    """
+    This function runs the iperf3 test and saves it to the reports and the columnar store
+    """
+    import measure_speed
+
+    result = measure_speed.run_test(job)
+    measure_speed.save_result(result, str(job["server"]), campaign=True)
+
+    if "error" in result:
+        raise RuntimeError(result["error"])
+
+    return {"sent_bps": result["end"]["sum_sent"]["bits_per_second"], "received_bps": result["end"]["sum_received"]["bits_per_second"]}
+
+
+def job_nodes(job: dict, context: dict) -> dict:
+    """
+    This function sweeps the prefixes with the native prober
+    """
+    import get_nodes
+
+    args = argparse.Namespace(mode="remote", ipv4=True, ipv6=True, backend="native", rate=job.get("rate", 1000),
+                              adaptive=job.get("adaptive", False), max_parallel=1)
+
+    return {"live_hosts": get_nodes.awake_neighbors(job["targets"], args)}
+
+
+def job_trace(job: dict, context: dict) -> list:
+    """
+    This function traces the destinations and augments them using the shared session and caches.
+    The caches are thread-safe, as the trace jobs may overlap
+    """
+    import trace_analyzer
+
+    geo_config = hs.import_config(job.get("config", "./gconfig.yml"))
+    cache_dir = trace_analyzer.get_cache_dir(geo_config)
+
+    with context["lock"]:
+        if "geo" not in context["caches"]:
+            context["caches"]["geo"] = hc.DiskCache(path=f"{cache_dir}/geo.json", ttl=geo_config.get("geo", {}).get("ttl", 86400))
+            context["caches"]["isp"] = hc.DiskCache(path=f"{cache_dir}/isp.json", ttl=geo_config.get("isp", {}).get("ttl", 604800))
+
+    result = trace_analyzer.trace_batch(job["targets"], job.get("family", "ipv4"), geo_config, job.get("workers", 10),
+                                        session=context["session"], geo_cache=context["caches"]["geo"],
+                                        isp_cache=context["caches"]["isp"])
+
+    if job.get("baseline"):
+        trace_analyzer.check_baseline(result, geo_config)
+
+    return result
+
+
+def job_packet_loss(job: dict, context: dict) -> list:
+    """
+    This function measures the packet loss towards the destinations
+    """
+    import measure_packet_loss
+
+    targets = measure_packet_loss.load_targets(job["targets"]) if isinstance(job["targets"], str) else job["targets"]
+    args = argparse.Namespace(count=job.get("count", 20), interval=job.get("interval_probe", 0.1),
+                              timeout=job.get("timeout", 1.0), rate=job.get("rate", 1000))
+
+    methods = {}
+    rtts = asyncio.run(measure_packet_loss.measure(targets, args, methods))
+
+    return [measure_packet_loss.get_stats(target, rtts[target], methods.get(target)) for target in targets]
+
+
+def run_job(job: dict, context: dict, lock: JobLock, status: dict) -> None:
+    """
+    This function runs the job under the lock and records its latest result
+    """
+    lock.acquire(job.get("exclusive", False))
+    started = datetime.datetime.now()
+
+    try:
+        with hs.metrics.span("job", job=job["name"]):
+            entry = {"result": jobs[job["type"]](job, context), "error": None}
+
+    except (Exception, SystemExit) as e:
+        entry = {"result": None, "error": str(e)}
+        hs.metrics.count("job_errors", job=job["name"])
+
+    finally:
+        lock.release(job.get("exclusive", False))
+
+    entry.update({"started": started.isoformat(timespec="seconds"),
+                  "duration": round((datetime.datetime.now() - started).total_seconds(), 3)})
+    status[job["name"]] = entry
+
+    # The textfile of the long-running process is refreshed after each job
+    if hs.metrics.fmt == "prometheus":
+        hs.metrics.export()
+
+    print(f"{entry['started']}: job {job['name']} completed in {entry['duration']} s" + (f" with error: {entry['error']}" if entry["error"] else ""))
+
+
+def start_status_server(host: str, port: int, status: dict) -> http.server.ThreadingHTTPServer:
+    """
+    This function exposes the latest results: GET / for all the jobs, GET /<job> for a single one
+    """
+    class StatusHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            name = self.path.strip("/")
+            data = dict(status) if not name else status.get(name)
+            body = json.dumps(data).encode("utf-8")
+
+            self.send_response(200 if data is not None else 404)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def schedule(job_list: list, context: dict, status: dict, max_workers: int = 4, stop: threading.Event = None) -> None:
+    """
+    This function runs the jobs periodically with jitter. The job is skipped, if its previous run is still in progress
+    """
+    lock = JobLock()
+    stop = stop if stop else threading.Event()
+    running = {}
+
+    # The first runs are spread within the jitter as well
+    queue = [(time.time() + random.uniform(0, job.get("jitter", 0)), index) for index, job in enumerate(job_list)]
+    heapq.heapify(queue)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while not stop.is_set():
+            due, index = queue[0]
+
+            if stop.wait(max(0, due - time.time())):
+                break
+
+            heapq.heappop(queue)
+            job = job_list[index]
+
+            if index not in running or running[index].done():
+                running[index] = executor.submit(run_job, job, context, lock, status)
+
+            heapq.heappush(queue, (due + job["interval"] + random.uniform(0, job.get("jitter", 0)), index))
+
+
+# Variables
+jobs = {
+    "public_ip": job_public_ip,
+    "speedtest": job_speedtest,
+    "iperf3": job_iperf3,
+    "nodes": job_nodes,
+    "trace": job_trace,
+    "packet_loss": job_packet_loss
+}
+
+
+# Body
+if __name__ == "__main__":
+    args = args_parser()
+    config = hs.import_config(args.config)
+
+    if "daemon" not in config or not config["daemon"].get("jobs"):
+        sys.exit(f"No jobs are defined in the daemon section of {args.config}.")
+
+    daemon_config = config["daemon"]
+
+    for job in daemon_config["jobs"]:
+        if job.get("type") not in jobs or not job.get("name") or not job.get("interval"):
+            sys.exit(f"Wrong job definition {job}. The name, interval and type ({', '.join(jobs)}) are required.")
+
+    context = {"config": config, "session": hs.get_session(pool_size=daemon_config.get("max_workers", 4)), "caches": {}, "lock": threading.Lock()}
+    status = {}
+
+    server = start_status_server(daemon_config.get("listen", "127.0.0.1"), daemon_config.get("port", 8080), status)
+    print(f"Status is available at http://{daemon_config.get('listen', '127.0.0.1')}:{daemon_config.get('port', 8080)}/")
+
+    try:
+        schedule(daemon_config["jobs"], context, status, daemon_config.get("max_workers", 4))
+
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit()
@@ -0,0 +1,43 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module makes the tools and helpers importable from the tests and points them to the captured fixtures.
+"""
+
+# Modules
+import os
+import sys
+
+import pytest
+
+
+# Variables
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+sys.path.insert(0, root_dir)
+
+
+# User-defined functions
+@pytest.fixture
+def fixture_text():
+    """
+    This fixture returns the content of the captured text file
+    """
+    def read(name: str) -> str:
+        with open(os.path.join(fixtures_dir, name), "r") as f:
+            return f.read()
+
+    return read
+
+
+@pytest.fixture
+def fixture_bytes():
+    """
+    This fixture returns the content of the captured binary dump
+    """
+    def read(name: str) -> bytes:
+        with open(os.path.join(fixtures_dir, name), "rb") as f:
+            return f.read()
+
+    return read
@@ -0,0 +1,146 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module checks the revalidation and resume of the downloads against the local HTTP server.
+"""
+
+# Modules
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+# Local modules
+import helpers.shared as hs
+
+
+# Variables
+content = b"00-00-00   (hex)\t\tACME\n" * 1000
+
+
+# Classes
+class RegistryHandler(http.server.BaseHTTPRequestHandler):
+    """
+    This class serves the registry with ETag, 304 and range support and records the requests
+    """
+    requests = []
+
+    def do_GET(self):
+        RegistryHandler.requests.append(dict(self.headers))
+
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = int(self.headers["Range"].split("=")[1].rstrip("-")) if "Range" in self.headers and \
+            self.headers.get("If-Range") == '"v1"' else 0
+
+        if start >= len(content):
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(content)}")
+            self.end_headers()
+            return
+
+        self.send_response(206 if start else 200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+# User-defined functions
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RegistryHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    RegistryHandler.requests = []
+
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/oui.txt"
+
+    httpd.shutdown()
+
+
+def expire(path: str) -> dict:
+    """
+    This function makes the local copy stale and returns its metadata
+    """
+    with open(f"{path}.meta", "r") as f:
+        meta = json.load(f)
+
+    meta["fetched"] = 0
+    hs.write_json(f"{path}.meta", meta)
+
+    return meta
+
+
+def test_not_modified_drops_stale_part(server, tmp_path):
+    path = hs.fetch_file(url=server, rdir=str(tmp_path))
+    meta = expire(path)
+
+    # The part left by the interrupted download of the earlier run
+    hs.write_json(f"{path}.meta", {**meta, "part_validator": '"v1"'})
+    with open(f"{path}.part", "wb") as f:
+        f.write(content[:100])
+
+    assert hs.fetch_file(url=server, rdir=str(tmp_path)) == path
+    assert not os.path.exists(f"{path}.part")
+
+    expire(path)
+    hs.fetch_file(url=server, rdir=str(tmp_path))
+
+    assert "Range" not in RegistryHandler.requests[-1]
+
+
+def test_corrupted_copy_is_downloaded(server, tmp_path):
+    path = hs.fetch_file(url=server, rdir=str(tmp_path))
+    expire(path)
+
+    # The same size, but different content
+    with open(path, "r+b") as f:
+        f.write(b"X")
+
+    hs.fetch_file(url=server, rdir=str(tmp_path))
+
+    assert "If-None-Match" not in RegistryHandler.requests[-1]
+
+    with open(path, "rb") as f:
+        assert f.read() == content
+
+
+def test_resume(server, tmp_path):
+    path = hs.fetch_file(url=server, rdir=str(tmp_path))
+    os.remove(path)
+
+    hs.write_json(f"{path}.meta", {"part_validator": '"v1"'})
+    with open(f"{path}.part", "wb") as f:
+        f.write(content[:100])
+
+    hs.fetch_file(url=server, rdir=str(tmp_path))
+
+    assert RegistryHandler.requests[-1]["Range"] == "bytes=100-"
+
+    with open(path, "rb") as f:
+        assert f.read() == content
+
+
+def test_complete_part(server, tmp_path):
+    path = hs.fetch_file(url=server, rdir=str(tmp_path))
+    os.remove(path)
+
+    # The process was stopped after the last chunk, but before the rename
+    hs.write_json(f"{path}.meta", {"part_validator": '"v1"'})
+    with open(f"{path}.part", "wb") as f:
+        f.write(content)
+
+    assert hs.fetch_file(url=server, rdir=str(tmp_path)) == path
+    assert [entry.get("Range") for entry in RegistryHandler.requests[-2:]] == [f"bytes={len(content)}-", None]
+    assert not os.path.exists(f"{path}.part")
+
+    with open(path, "rb") as f:
+        assert f.read() == content
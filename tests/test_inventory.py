@@ -0,0 +1,75 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module checks the change tracking of the hosts inventory across the detailed and plain runs.
+"""
+
+# Modules
+import sqlite3
+
+# Local modules
+import helpers.inventory as hinv
+
+
+# User-defined functions
+def test_plain_run_keeps_mac_and_vendor():
+    conn = hinv.open_inventory(":memory:")
+    scope = ["192.0.2.0/24"]
+
+    assert hinv.update_inventory(conn, [{"ip": "192.0.2.1", "mac": "AA-00-00-00-00-01", "vendor": "Acme"}], scope) == [
+        {"change": "appeared", "ip": "192.0.2.1", "mac": "AA-00-00-00-00-01", "vendor": "Acme"}]
+
+    # The non-detailed run knows the IP only
+    assert hinv.update_inventory(conn, [{"ip": "192.0.2.1"}], scope) == []
+    assert hinv.known_vendors(conn, ["AA-00-00-00-00-01"]) == {"AA-00-00-00-00-01": "Acme"}
+
+    assert hinv.update_inventory(conn, [{"ip": "192.0.2.1", "mac": "AA-00-00-00-00-02"}], scope) == [
+        {"change": "mac_changed", "old_mac": "AA-00-00-00-00-01", "ip": "192.0.2.1", "mac": "AA-00-00-00-00-02"}]
+    assert hinv.known_vendors(conn, ["AA-00-00-00-00-01", "AA-00-00-00-00-02"]) == {}
+
+
+def test_disappeared_keeps_details():
+    conn = hinv.open_inventory(":memory:")
+    scope = ["192.0.2.0/24"]
+
+    hinv.update_inventory(conn, [{"ip": "192.0.2.1", "mac": "AA-00-00-00-00-01", "vendor": "Acme"}], scope)
+    hinv.update_inventory(conn, [{"ip": "192.0.2.1"}], scope)
+    result = hinv.update_inventory(conn, [], scope)
+
+    assert [(entry["change"], entry["mac"], entry["vendor"]) for entry in result] == [("disappeared", "AA-00-00-00-00-01", "Acme")]
+
+
+def test_other_prefixes_are_not_touched():
+    conn = hinv.open_inventory(":memory:")
+
+    hinv.update_inventory(conn, [{"ip": "192.0.2.1"}, {"ip": "198.51.100.1"}, {"ip": "2001:db8::1"}],
+                          ["192.0.2.0/24", "198.51.100.0/24", "2001:db8::/64"])
+
+    # The hosts outside of the scanned prefix neither disappear nor are loaded
+    result = hinv.update_inventory(conn, [], ["192.0.2.0/30"])
+
+    assert [(entry["change"], entry["ip"]) for entry in result] == [("disappeared", "192.0.2.1")]
+    assert [row[0] for row in conn.execute("SELECT ip FROM hosts WHERE present = 1 ORDER BY ip_key")] == ["198.51.100.1", "2001:db8::1"]
+
+
+def test_key_order():
+    keys = [hinv.get_key(ip) for ip in ["9.255.255.255", "10.0.0.1", "10.0.0.2", "10.0.1.0", "::1", "2001:db8::1"]]
+
+    assert keys == sorted(keys)
+    assert hinv.get_key("example.com") is None
+
+
+def test_inventory_migration(tmp_path):
+    path = str(tmp_path / "inventory.sqlite")
+
+    # The inventory of the earlier version without ip_key
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE hosts (ip TEXT PRIMARY KEY, mac TEXT, vendor TEXT, details TEXT, "
+                 "first_seen TEXT, last_seen TEXT, present INTEGER)")
+    conn.execute("INSERT INTO hosts VALUES ('192.0.2.1', NULL, NULL, '{\"ip\": \"192.0.2.1\"}', 'x', 'x', 1)")
+    conn.commit()
+    conn.close()
+
+    conn = hinv.open_inventory(path)
+
+    assert [entry["change"] for entry in hinv.update_inventory(conn, [], ["192.0.2.0/24"])] == ["disappeared"]
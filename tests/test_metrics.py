@@ -0,0 +1,35 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module checks the export of the metrics.
+"""
+
+# Modules
+import concurrent.futures
+import os
+
+# Local modules
+import helpers.shared as hs
+
+
+# User-defined functions
+def test_concurrent_prometheus_export(tmp_path):
+    metrics = hs.Metrics(tool="probe_daemon", fmt="prometheus", path=str(tmp_path))
+
+    def job(index: int) -> None:
+        with metrics.span("job", job=f"job{index % 4}"):
+            metrics.count("checks", job=f"job{index % 4}")
+
+        metrics.export()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(job, range(64)))
+
+    # No temporary files are left and the published file is complete
+    assert os.listdir(tmp_path) == ["probe_daemon.prom"]
+
+    with open(tmp_path / "probe_daemon.prom", "r") as f:
+        lines = f.read().splitlines()
+
+    assert sum(int(line.split()[-1]) for line in lines if line.startswith("troubleshooting_events")) == 64
+    assert lines[-1].startswith("troubleshooting_last_run_timestamp_seconds")
@@ -0,0 +1,94 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module replays the captured /proc/net files and rtnetlink dumps through the parsers of helpers.netlink.
+"""
+
+# Modules
+import socket
+import struct
+
+# Local modules
+import helpers.netlink as hn
+import get_nodes
+
+
+# User-defined functions
+def build_neigh(family: int, state: int, dst: bytes, lladdr: bytes = None) -> bytes:
+    """
+    This function builds a single RTM_NEWNEIGH message
+    """
+    attrs = struct.pack("=HH", 4 + len(dst), hn.NDA_DST) + dst + b"\x00" * (-len(dst) % 4)
+
+    if lladdr:
+        attrs += struct.pack("=HH", 4 + len(lladdr), hn.NDA_LLADDR) + lladdr + b"\x00" * (-len(lladdr) % 4)
+
+    body = struct.pack("=BBHiHBB", family, 0, 0, 4, state, 0, 0) + attrs
+
+    return struct.pack("=IHHII", 16 + len(body), hn.RTM_NEWNEIGH, 2, 1, 0) + body
+
+
+def test_parse_proc_arp(fixture_text):
+    result = hn.parse_proc_arp(fixture_text("proc_net_arp.txt"))
+
+    # Incomplete entries (flags 0x0) are skipped
+    assert result == [{"ip": "192.0.2.1", "family": 4, "mac": "02-FC-00-00-00-05", "interface": "eth0", "hw_type": "0x1"},
+                      {"ip": "192.0.2.20", "family": 4, "mac": "0A-1B-2C-3D-4E-5F", "interface": "eth0", "hw_type": "0x1"}]
+
+
+def test_parse_if_inet6(fixture_text):
+    result = hn.parse_if_inet6(fixture_text("if_inet6.txt"))
+
+    assert result == [{"ip": "fd00::2", "index": 4, "prefixlen": 64, "scope": 0, "interface": "eth0"},
+                      {"ip": "fe80::fc:ff:fe00:1", "index": 4, "prefixlen": 64, "scope": 0x20, "interface": "eth0"},
+                      {"ip": "::1", "index": 1, "prefixlen": 128, "scope": 0x10, "interface": "lo"}]
+
+
+def test_parse_addr_dump(fixture_bytes):
+    assert hn.parse_addr_dump(fixture_bytes("addr_ipv4.bin")) == [
+        {"index": 1, "family": 4, "scope": 254, "ip": "127.0.0.1", "prefixlen": 8},
+        {"index": 4, "family": 4, "scope": 0, "ip": "192.0.2.2", "prefixlen": 24}]
+
+    assert hn.parse_addr_dump(fixture_bytes("addr_ipv6.bin")) == [
+        {"index": 1, "family": 6, "scope": 254, "ip": "::1", "prefixlen": 128},
+        {"index": 4, "family": 6, "scope": 0, "ip": "fd00::2", "prefixlen": 64},
+        {"index": 4, "family": 6, "scope": 253, "ip": "fe80::fc:ff:fe00:1", "prefixlen": 64}]
+
+
+def test_parse_neigh_dump(fixture_bytes):
+    # The failed (192.0.2.9, .77, .10) and noarp (0.0.0.0 on lo) entries are skipped
+    assert hn.parse_neigh_dump(fixture_bytes("neigh_ipv4.bin")) == [
+        {"index": 4, "family": 4, "ip": "192.0.2.1", "mac": "02-FC-00-00-00-05"}]
+
+    # The IPv6 dump has the noarp multicast and loopback entries only
+    assert hn.parse_neigh_dump(fixture_bytes("neigh_ipv6.bin")) == []
+
+
+def test_parse_neigh_dump_states():
+    dump = build_neigh(socket.AF_INET, hn.NUD_INCOMPLETE, bytes([192, 0, 2, 30])) + \
+        build_neigh(socket.AF_INET, hn.NUD_FAILED, bytes([192, 0, 2, 31]), bytes(6)) + \
+        build_neigh(socket.AF_INET, hn.NUD_NOARP, bytes([192, 0, 2, 32]), bytes(6)) + \
+        build_neigh(socket.AF_INET, 0x02, bytes([192, 0, 2, 33])) + \
+        build_neigh(socket.AF_INET6, 0x02, bytes.fromhex("fd000000000000000000000000000005"), bytes.fromhex("0a1b2c3d4e5f"))
+
+    # Only the reachable entry with the link-layer address is kept
+    assert hn.parse_neigh_dump(dump) == [{"index": 4, "family": 6, "ip": "fd00::5", "mac": "0A-1B-2C-3D-4E-5F"}]
+
+
+def test_neighbor_type_matches_arp(fixture_text):
+    arp = {entry["ip"]: entry for entry in get_nodes.parse_arp(fixture_text("arp_an.txt"), "Linux")}
+    proc = hn.parse_proc_arp(fixture_text("proc_net_arp.txt"))
+
+    assert sorted(arp) == sorted(entry["ip"] for entry in proc)
+
+    for entry in proc:
+        assert entry["mac"] == arp[entry["ip"]]["mac"]
+        assert entry["interface"] == arp[entry["ip"]]["interface"]
+        assert hn.neighbor_type(entry["mac"], entry["hw_type"]) == arp[entry["ip"]]["type"]
+
+
+def test_neighbor_type_special():
+    assert hn.neighbor_type("01-00-5E-00-00-FB") == "multicast"
+    assert hn.neighbor_type("33-33-00-00-00-16") == "multicast"
+    assert hn.neighbor_type("FF-FF-FF-FF-FF-FF") == "broadcast"
+    assert hn.neighbor_type("0A-1B-2C-3D-4E-5F", "0x20") == "0x20"
@@ -0,0 +1,63 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module checks the streaming writer of the results.
+"""
+
+# Modules
+import contextlib
+import gzip
+import io
+import os
+import sys
+
+# Local modules
+import helpers.output as ho
+
+
+# User-defined functions
+def test_stdout_stays_open(monkeypatch):
+    stdout, stderr = io.StringIO(), io.StringIO()
+    monkeypatch.setattr(sys, "stdout", stdout)
+
+    writer = ho.RecordWriter(path="-")
+
+    # The tools close the writer, while their messages are redirected to stderr
+    with contextlib.redirect_stdout(stderr):
+        writer.write({"ip": "192.0.2.1"})
+        writer.close()
+
+    print("Results: stdout")
+
+    assert not stdout.closed
+    assert stdout.getvalue() == '{"ip":"192.0.2.1"}\nResults: stdout\n'
+
+
+def test_rotation_naming(tmp_path):
+    names = []
+
+    for path, compress in [("by_flag.ndjson", "gzip"), ("by_ext.ndjson.gz", "")]:
+        writer = ho.RecordWriter(path=str(tmp_path / path), compress=compress, rotate_mb=0.000005)
+
+        for i in range(3):
+            writer.write({"i": i})
+
+        writer.close()
+        names.append([os.path.basename(fn) for fn in writer.files])
+
+    assert names == [["by_flag.ndjson.gz", "by_flag.1.ndjson.gz", "by_flag.2.ndjson.gz"],
+                     ["by_ext.ndjson.gz", "by_ext.1.ndjson.gz", "by_ext.2.ndjson.gz"]]
+
+    with gzip.open(tmp_path / "by_ext.1.ndjson.gz", "rt") as f:
+        assert f.read() == '{"i":1}\n'
+
+
+def test_csv_header_per_file(tmp_path):
+    writer = ho.RecordWriter(path=str(tmp_path / "hosts.csv"), fmt="csv", fields=["change", "ip", "mac"], rotate_mb=0.00002)
+
+    writer.write({"change": "appeared", "ip": "192.0.2.1"})
+    writer.write({"change": "mac_changed", "ip": "192.0.2.2", "mac": "AA-00-00-00-00-01"})
+    writer.close()
+
+    with open(writer.files[-1], "r") as f:
+        assert f.read() == "change,ip,mac\nmac_changed,192.0.2.2,AA-00-00-00-00-01\n"
@@ -0,0 +1,115 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module checks the adaptive timeout of the native prober with the simulated RTTs
+and the real ICMP and TCP probes towards the loopback.
+"""
+
+# Modules
+import asyncio
+import socket
+
+import pytest
+
+# Local modules
+import helpers.prober as hpr
+
+
+# User-defined functions
+def simulate(rtts: dict, count: int = 2) -> tuple:
+    """
+    This function runs the adaptive sweep, where the host answers, if the timeout is above its RTT (ms)
+    """
+    prober = hpr.Prober(timeout=1.0, rate=100000, count=count)
+    timeouts = {}
+
+    async def probe_once(ip, timeout: float) -> tuple:
+        timeouts.setdefault(ip.compressed, []).append(timeout)
+        rtt = rtts.get(ip.compressed)
+
+        return (rtt, "icmp") if rtt is not None and rtt / 1000 < timeout else (None, "icmp")
+
+    prober._probe_once = probe_once
+
+    return asyncio.run(prober.adaptive_sweep(list(rtts))), timeouts
+
+
+def probe_loopback(prober) -> dict:
+    """
+    This function probes 127.0.0.1 with the real backend and releases the sockets within the same loop
+    """
+    async def run() -> dict:
+        try:
+            return (await prober.sweep(["127.0.0.1"]))[0]
+
+        finally:
+            prober.close()
+
+    return asyncio.run(run())
+
+
+def get_closed_port() -> int:
+    """
+    This function returns the TCP port on the loopback, which nothing listens on
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+
+        return sock.getsockname()[1]
+
+
+def test_estimate_per_prefix():
+    rtts = {f"192.0.2.{i}": 1.0 for i in range(1, 51)}
+    rtts["198.51.100.1"] = 150.0
+
+    result, timeouts = simulate(rtts, count=1)
+
+    # The fast LAN replies don't shorten the timeout towards the other /24
+    assert all(probe["alive"] for probe in result)
+    assert timeouts["198.51.100.1"] == [1.0]
+
+
+def test_retry_uses_configured_timeout():
+    rtts = {f"192.0.2.{i}": 1.0 for i in range(1, 51)}
+    rtts["192.0.2.100"] = 150.0
+
+    result, timeouts = simulate(rtts, count=2)
+
+    assert {probe["ip"]: probe["alive"] for probe in result}["192.0.2.100"]
+    assert timeouts["192.0.2.100"][-1] == 1.0
+    assert min(min(values) for values in timeouts.values()) == 0.1
+
+
+def test_tcp_fallback_refused():
+    prober = hpr.Prober(timeout=1.0, count=1, tcp_port=get_closed_port())
+
+    # ICMP sockets aren't permitted, hence TCP is used and the RST (ECONNREFUSED) means the host is alive
+    prober._sockets = {4: None}
+    result = probe_loopback(prober)
+
+    assert result["alive"] and result["method"] == "tcp"
+    assert result["rtt"] is not None and result["attempts"] == 1
+
+
+def test_tcp_fallback_open():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+
+        prober = hpr.Prober(timeout=1.0, count=1, tcp_port=server.getsockname()[1])
+        prober._sockets = {4: None}
+        result = probe_loopback(prober)
+
+    assert result["alive"] and result["method"] == "tcp"
+
+
+def test_icmp_loopback():
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP).close()
+
+    except OSError:
+        pytest.skip("ICMP datagram sockets aren't permitted (net.ipv4.ping_group_range)")
+
+    result = probe_loopback(hpr.Prober(timeout=1.0, count=2))
+
+    assert result["alive"] and result["method"] == "icmp"
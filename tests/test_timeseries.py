@@ -0,0 +1,55 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module checks the columnar store of the iperf3 results.
+"""
+
+# Modules
+import datetime
+import os
+
+# Local modules
+import helpers.timeseries as hts
+
+
+# User-defined functions
+def test_append_after_interrupted_append(tmp_path):
+    root = str(tmp_path)
+    hts.append(root, "server", {"summary": [(1600000000.0, 1.0, 2.0, 3.0, 4.0)]})
+
+    # The interrupted append has written only the first columns and a part of the value
+    path = os.path.join(root, "server", "summary", datetime.datetime.fromtimestamp(1600000000.0).strftime("%Y-%m-%d"))
+    with open(os.path.join(path, "ts.f64"), "ab") as f:
+        f.write(b"\x00" * 8)
+
+    with open(os.path.join(path, "sent_bps.f64"), "ab") as f:
+        f.write(b"\x00" * 3)
+
+    hts.append(root, "server", {"summary": [(1600000060.0, 5.0, 6.0, 7.0, 8.0)]})
+    result = hts.load(root, "server", "summary")
+
+    assert list(result["ts"]) == [1600000000.0, 1600000060.0]
+    assert list(result["sent_bps"]) == [1.0, 5.0]
+    assert list(result["rtt"]) == [4.0, 8.0]
+
+
+def test_load_window(tmp_path):
+    root = str(tmp_path)
+    start = datetime.datetime(2021, 5, 1, 12, 0).timestamp()
+
+    # The second test overlaps with the first one, so the segment of the intervals isn't sorted
+    hts.append(root, "server", {"intervals": [(start + i, float(i), 0.0, 1.0) for i in range(10)]})
+    hts.append(root, "server", {"intervals": [(start + 5 + i, float(100 + i), 0.0, 1.0) for i in range(10)]})
+    hts.append(root, "server", {"summary": [(start + i * 60, float(i), 0.0, 0.0, 1.0) for i in range(10)]})
+
+    since, until = datetime.datetime.fromtimestamp(start + 120), datetime.datetime.fromtimestamp(start + 300)
+    assert list(hts.load(root, "server", "summary", since, until)["sent_bps"]) == [2.0, 3.0, 4.0, 5.0]
+
+    since, until = datetime.datetime.fromtimestamp(start + 8), datetime.datetime.fromtimestamp(start + 10)
+    assert list(hts.load(root, "server", "intervals", since, until)["bits_per_second"]) == [8.0, 9.0, 103.0, 104.0, 105.0]
+
+    assert len(hts.load(root, "server", "intervals")["ts"]) == 20
+
+
+def test_tumbling():
+    assert hts.tumbling([0, 10, 60, 70, 130], [1.0, 3.0, 5.0, float("nan"), 7.0], 60) == [(0, 2.0), (60, 5.0), (120, 7.0)]
@@ -0,0 +1,43 @@
+#(c)2019-2021, karneliuk.com
+
+"""
+This module checks that the streaming trace starts the Geo lookups while the MTR is still running.
+"""
+
+# Modules
+import threading
+
+# Local modules
+import helpers.cache as hc
+import trace_analyzer
+
+
+# User-defined functions
+def test_stream_enriches_early_hops(tmp_path, monkeypatch):
+    looked_up = threading.Event()
+    calls = []
+
+    def fake_stream(target, target_type, cycles):
+        for count, host in enumerate(["192.168.0.1", "8.8.8.8", "1.1.1.1", "8.8.8.8"], start=1):
+            yield {"count": count, "host": host}
+
+            # The lookup of the first public hop completes before the trace is over
+            if host == "8.8.8.8" and count == 2:
+                assert looked_up.wait(timeout=5)
+
+    def fake_geo(ips, geo_config, session):
+        calls.extend(ips)
+        looked_up.set()
+
+        return {ip: {"city": "Test"} for ip in ips}
+
+    monkeypatch.setattr(trace_analyzer, "stream_path", fake_stream)
+    monkeypatch.setattr(trace_analyzer, "get_geo_data", fake_geo)
+
+    cache = hc.DiskCache(path=str(tmp_path / "geo.json"))
+    result = trace_analyzer.get_path_stream("example.com", geo_config={"geo": {"workers": 2}}, cache=cache)
+
+    # Private hops are skipped and each public hop is looked up once
+    assert sorted(calls) == ["1.1.1.1", "8.8.8.8"]
+    assert cache.get("8.8.8.8") == {"city": "Test"}
+    assert [hub["host"] for hub in result["report"]["hubs"]] == ["192.168.0.1", "8.8.8.8", "1.1.1.1", "8.8.8.8"]
@@ -1,23 +1,93 @@
 #!/usr/bin/env python
 
 # Modules
-import yaml
 import subprocess
 import sys
 import json
-import requests
-from tqdm import tqdm
-import folium
 import re
-from pyvis.network import Network
+import concurrent.futures
+import argparse
+import statistics
+import math
+import socket
+import os
+import html
+import contextlib
+
+# Local modules
+import helpers.shared as hs
+import helpers.cache as hc
+import helpers.baseline as hb
+import helpers.output as ho
+
+# Lazy modules
+requests = hs.lazy_import("requests")
+tqdm = hs.lazy_import("tqdm")
+folium = hs.lazy_import("folium")
+folium_plugins = hs.lazy_import("folium.plugins")
+pyvis_network = hs.lazy_import("pyvis.network")
 
 
 # Variables
 config_file = "./gconfig.yml"
 destination = ("google.com", "ipv6")
+map_formats = ["html", "compact", "geojson", "svg"]
 
 
 # User-defined functions
+def args_parser():
+    """
+    This function contains information about arguments you provide for the script to run
+    """
+    parser = argparse.ArgumentParser(description="Trace the path to the destination and augment it with Geo and ISP data.")
+
+    parser.add_argument("mode", nargs="?", default="map",
+                        help="Provide the execution mode. Options: map, isp or batch.")
+    parser.add_argument("--targets", dest="targets", type=str, default="./targets.txt",
+                        help="Provide the file with destinations, one per line. Works with batch.")
+    parser.add_argument("--family", dest="family", type=str, default="ipv4",
+                        help="Provide the address family for the traces. Options: ipv4 or ipv6. Works with batch.")
+    parser.add_argument("--workers", dest="workers", type=int, default=10,
+                        help="Provide the amount of concurrent traces. Works with batch.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Specify if you want to see the hops while the trace is running. Works with map.")
+    parser.add_argument("--graph", action="store_true",
+                        help="Specify if you want to build the merged topology of all the traces. Works with batch.")
+    parser.add_argument("--format", dest="format", type=str, default="ndjson",
+                        help="Provide the format of the results: ndjson (a trace per line, ./trace_batch.jsonl by default) or csv (a hop per line, ./trace_batch.csv by default). Works with batch.")
+    ho.add_arguments(parser, default_output="")
+    parser.add_argument("--map-format", dest="map_format", type=str, default="",
+                        help="Provide the map format: html (a marker per hop), compact (clustered GeoJSON), geojson or svg. "
+                             "By default result.map_format from the config or html. Works with map and batch.")
+    parser.add_argument("--map", action="store_true",
+                        help="Specify if you want to build the combined map of all the traces. Works with batch.")
+    parser.add_argument("--baseline", action="store_true",
+                        help="Specify if you want to check the hops against their baseline and flag the latency, loss and path anomalies.")
+
+    result = parser.parse_args()
+
+    if result.mode not in {"map", "isp", "batch"}:
+        sys.exit("Wrong operations mode. Must be map, isp or batch")
+
+    # The raw output of mtr has no ASNs, hence the ISPs cannot be resolved
+    if result.stream and result.mode == "isp":
+        sys.exit("The stream is not supported in isp mode, as the raw output of mtr has no ASNs")
+
+    if result.format not in ho.formats:
+        sys.exit(f"Wrong output format. Must be {', '.join(ho.formats)}")
+
+    # The default file of the batch results follows the format
+    result.output = result.output if result.output else f"./trace_batch.{'csv' if result.format == 'csv' else 'jsonl'}"
+
+    if result.map_format and result.map_format not in map_formats:
+        sys.exit(f"Wrong map format. Must be {', '.join(map_formats)}")
+
+    if result.workers < 1:
+        sys.exit("The amount of concurrent traces must be at least 1.")
+
+    return result
+
+
 def get_path(target: str, target_type: str = "ipv4") -> dict:
     """
     This function runs the MTR and collects its output in JSON format
@@ -32,10 +102,12 @@ def get_path(target: str, target_type: str = "ipv4") -> dict:
     target_type = "-6" if target_type == "ipv6" else "-4"
     args = ["mtr", target_type, target, "-n", "-z", "-j"]
 
-    result_raw = subprocess.run(args=args, capture_output=True)
-    
+    with hs.metrics.span("exec", command="mtr"):
+        result_raw = subprocess.run(args=args, capture_output=True)
+
     if not result_raw.stderr:
-        result = json.loads(result_raw.stdout.decode("utf-8"))
+        with hs.metrics.span("parse", source="mtr"):
+            result = json.loads(result_raw.stdout.decode("utf-8"))
 
     else:
         sys.exit(f"There is some error with trace happened: {result_raw.stderr.decode('utf-8')}")
@@ -45,30 +117,200 @@ def get_path(target: str, target_type: str = "ipv4") -> dict:
     return result
 
 
-def augment_geo_data(mtr_result: dict, geo_config: dict) -> dict:
+def stream_path(target: str, target_type: str = "ipv4", cycles: int = 10):
     """
-    This function augments the traceroute with the Geo data
+    This function runs the MTR in raw mode and yields the hop (in the MTR JSON format) each time it is updated.
+    The raw mode doesn't provide the ASN, hence it is reported as AS???
+    """
+    allowed_types = {"ipv4", "ipv6"}
+
+    if target_type not in allowed_types:
+        sys.exit(f"Unsupported path type. Only {', '.join(allowed_types)} are supported.")
+
+    target_type = "-6" if target_type == "ipv6" else "-4"
+    args = ["mtr", target_type, target, "-n", "-l", "-c", str(cycles)]
+
+    # Local vars
+    hubs = {}
+    samples = {}
+    sent = {}
+
+    with subprocess.Popen(args=args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as proc:
+        for line in proc.stdout:
+            fields = line.split()
+
+            if len(fields) < 3 or not fields[1].isdigit():
+                continue
+
+            pos = int(fields[1])
+
+            # New hop is discovered
+            if fields[0] == "h" and pos not in hubs:
+                hubs[pos] = {"count": pos + 1, "host": fields[2], "ASN": "AS???", "Loss%": 0.0, "Snt": 0,
+                             "Last": 0.0, "Avg": 0.0, "Best": 0.0, "Wrst": 0.0, "StDev": 0.0}
+                samples[pos] = []
+
+            # Probe is transmitted, that may happen before the hop is discovered
+            elif fields[0] == "x":
+                sent[pos] = sent.get(pos, 0) + 1
+
+                if pos not in hubs:
+                    continue
+
+            # Reply is received, RTT is in microseconds
+            elif fields[0] == "p" and pos in hubs:
+                samples[pos].append(int(fields[2]) / 1000)
+
+            else:
+                continue
+
+            yield update_hop_stats(hubs[pos], samples[pos], sent.get(pos, 0))
+
+        if proc.wait() and not hubs:
+            sys.exit(f"There is some error with trace happened: {proc.stderr.read()}")
+
+    # Finalizing the loss, if the MTR doesn't report transmitted probes
+    for pos, hub in hubs.items():
+        if not sent.get(pos):
+            yield update_hop_stats(hub, samples[pos], cycles)
+
+
+def update_hop_stats(hub: dict, rtts: list, sent: int) -> dict:
+    """
+    This function updates the statistics of the hop from the collected RTTs
+    """
+    snt = max(sent, len(rtts))
+
+    hub.update({"Snt": snt, "Loss%": round((snt - len(rtts)) / snt * 100, 1) if snt else 0.0})
+
+    if rtts:
+        hub.update({"Last": round(rtts[-1], 2), "Avg": round(statistics.mean(rtts), 2), "Best": round(min(rtts), 2),
+                    "Wrst": round(max(rtts), 2), "StDev": round(statistics.pstdev(rtts), 2)})
+
+    return hub
+
+
+def get_path_stream(target: str, target_type: str = "ipv4", cycles: int = 10, geo_config: dict = None, session=None, cache=None) -> dict:
+    """
+    This function prints the hops while the MTR is running and returns the final aggregate in the MTR JSON format.
+    If the Geo config is provided, the lookup of each new public hop starts as soon as the hop is discovered
+    and the results are stored in the cache, so that augment_geo_data has only the missing hops to collect
+    """
+    hubs = {}
+    futures = {}
+
+    print(f"Tracing the path to {target} over {target_type} (streaming)...")
+
+    with contextlib.ExitStack() as stack:
+        executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=geo_config["geo"].get("workers", 10))) \
+            if geo_config and "geo" in geo_config and cache is not None else None
+
+        with hs.metrics.span("exec", command="mtr", mode="stream"):
+            for hub in stream_path(target, target_type, cycles):
+                if hub["count"] not in hubs:
+                    print(f"Hop {hub['count']}: {hub['host']}")
+
+                    if executor and hub["host"] not in futures and hs.is_public_ip(hub["host"]) and hub["host"] not in cache:
+                        futures[hub["host"]] = executor.submit(get_geo_data, [hub["host"]], geo_config, session)
+
+                hubs[hub["count"]] = hub
+
+        for future in concurrent.futures.as_completed(futures.values()):
+            for ip, geo in future.result().items():
+                cache.set(ip, geo, negative=not geo)
+
+    print("Tracing completed.")
+
+    result = {"report": {"mtr": {"src": socket.gethostname(), "dst": target, "tests": cycles},
+                         "hubs": [hubs[count] for count in sorted(hubs)]}}
+
+    return result
+
+
+@hs.metrics.timed("enrich", source="geo")
+def augment_geo_data(mtr_result: dict, geo_config: dict, session=None, cache=None, save: bool = True) -> dict:
+    """
+    This function augments the traceroute with the Geo data. Only public IPs missing in the cache are looked up.
+    The cache is written to disk, unless save is False (the caller saves it once for many traces)
     """
     result = mtr_result
 
-    for he in tqdm(result["report"]["hubs"], desc="Collecting Geo data", colour="blue"):
-        url = f"{geo_config['geo']['url']}/{he['host']}?access_key={geo_config['geo']['token']}"
-        response = requests.get(url=url)
+    # Preparing the shared session and cache
+    session = session if session else hs.get_session(pool_size=geo_config["geo"].get("workers", 10))
+    cache = cache if cache else hc.DiskCache(path=f"{get_cache_dir(geo_config)}/geo.json",
+                                             ttl=geo_config["geo"].get("ttl", 86400))
+
+    # Deduplicating the hops and skipping private/bogon addresses
+    lookup = sorted({he["host"] for he in result["report"]["hubs"] if hs.is_public_ip(he["host"]) and he["host"] not in cache})
+
+    # Using the bulk endpoint, if the provider supports that
+    if geo_config["geo"].get("bulk"):
+        bulk_size = geo_config["geo"].get("bulk_size", 50)
+        chunks = [lookup[i:i + bulk_size] for i in range(0, len(lookup), bulk_size)]
+
+    else:
+        chunks = [[ip] for ip in lookup]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=geo_config["geo"].get("workers", 10)) as executor:
+        futures = [executor.submit(get_geo_data, chunk, geo_config, session) for chunk in chunks]
+
+        for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Collecting Geo data", colour="blue"):
+            for ip, geo in future.result().items():
+                cache.set(ip, geo, negative=not geo)
+
+    if save:
+        cache.save()
+
+    for he in result["report"]["hubs"]:
+        he.update({"geo": cache.get(he["host"], {}) if hs.is_public_ip(he["host"]) else {}})
+
+    return result
+
+
+def get_geo_data(ips: list, geo_config: dict, session) -> dict:
+    """
+    This function collects the Geo data for one IP or for the chunk of IPs using the bulk endpoint
+    """
+    result = {ip: {} for ip in ips}
+    url = f"{geo_config['geo']['url']}/{','.join(ips)}?access_key={geo_config['geo']['token']}"
+
+    try:
+        response = session.get(url=url, timeout=geo_config["geo"].get("timeout", 5))
 
         if response.status_code == 200:
-            try:
-                he.update({"geo": response.json()})
+            data = response.json()
+
+            # Provider errors are returned with HTTP 200 and "success": false
+            if len(ips) == 1 and isinstance(data, dict) and data.get("success", True):
+                result.update({ips[0]: data})
+
+            elif isinstance(data, list):
+                result.update({entry["ip"]: entry for entry in data if entry.get("ip") in result})
 
-            except json.decoder.JSONDecodeError as e:
-                he.update({"geo": {}})
+    except (requests.exceptions.RequestException, json.decoder.JSONDecodeError):
+        hs.metrics.count("http_errors", api="geo")
 
     return result
 
 
-def build_map(mtr_result: dict, geo_config: dict) -> None:
+def get_cache_dir(geo_config: dict) -> str:
     """
-    This function builds the map of the trace
+    This function returns the directory for the persistent caches
     """
+    return geo_config.get("paths", {}).get("cache", "./.cache")
+
+
+@hs.metrics.timed("render", output="map")
+def build_map(mtr_result: dict, geo_config: dict, fmt: str = "") -> None:
+    """
+    This function builds the map of the trace. The formats other than html are rendered by render_map
+    """
+    fmt = fmt if fmt else geo_config["result"].get("map_format", "html")
+
+    if fmt != "html":
+        render_map([mtr_result], geo_config, fmt)
+        return
+
     m = folium.Map()
 
     print("Drawing the map...")
@@ -93,35 +335,201 @@ def build_map(mtr_result: dict, geo_config: dict) -> None:
     m.save(geo_config["result"]["file_map"])
 
 
-def augment_isp(mtr_result: dict, geo_config: dict) -> dict:
+def build_geojson(traces: list) -> dict:
+    """
+    This function converts the traces to the compact GeoJSON. The hops with the same coordinates are merged into
+    a single point and the links between them are merged into a single MultiLineString
+    """
+    points = {}
+    segments = {}
+
+    for tr in traces:
+        prev = None
+
+        for he in tr["report"]["hubs"]:
+            geo = he.get("geo")
+
+            if not geo or geo.get("latitude") is None or geo.get("longitude") is None:
+                continue
+
+            key = (round(geo["longitude"], 4), round(geo["latitude"], 4))
+            point = points.setdefault(key, {"location": ", ".join(str(geo[k]) for k in ("city", "country_name") if geo.get(k)),
+                                            "hosts": set(), "asns": set(), "hops": 0})
+            point["hosts"].add(he["host"])
+            point["asns"].add(re.sub("AS", "", he.get("ASN", "AS???")))
+            point["hops"] += 1
+
+            if prev and prev != key:
+                segments[(prev, key)] = segments.get((prev, key), 0) + 1
+
+            prev = key
+
+    features = [{"type": "Feature", "geometry": {"type": "Point", "coordinates": list(key)},
+                 "properties": {"location": point["location"], "hosts": ", ".join(sorted(point["hosts"])),
+                                "asns": ", ".join(sorted(point["asns"])), "hops": point["hops"]}}
+                for key, point in points.items()]
+
+    if segments:
+        features.append({"type": "Feature", "geometry": {"type": "MultiLineString", "coordinates": [[list(a), list(b)] for a, b in segments]},
+                         "properties": {"links": len(segments)}})
+
+    return {"type": "FeatureCollection", "features": features}
+
+
+@hs.metrics.timed("render", output="map_compact")
+def render_map(traces: list, geo_config: dict, fmt: str = "compact") -> str:
+    """
+    This function renders the traces as the compact map (clustered GeoJSON layer), GeoJSON or SVG file
+    and returns its path. The compact map may refer to the shared copy of Leaflet set by result.assets
     """
-    This function augments the traceroute with ISP information
+    collection = build_geojson(traces)
+    path = geo_config["result"]["file_map"] if fmt == "compact" else f"{os.path.splitext(geo_config['result']['file_map'])[0]}.{fmt}"
+
+    print("Drawing the map...")
+
+    if fmt == "geojson":
+        with open(path, "w") as f:
+            json.dump(collection, f, separators=(",", ":"))
+
+    elif fmt == "svg":
+        with open(path, "w") as f:
+            f.write(build_svg(collection))
+
+    else:
+        m = folium.Map(tiles=geo_config["result"].get("tiles", "OpenStreetMap"))
+        cluster = folium_plugins.MarkerCluster().add_to(m)
+        points = {"type": "FeatureCollection", "features": [e for e in collection["features"] if e["geometry"]["type"] == "Point"]}
+        lines = {"type": "FeatureCollection", "features": [e for e in collection["features"] if e["geometry"]["type"] != "Point"]}
+
+        # The popups are built in the browser from the properties of the features
+        folium.GeoJson(points, popup=folium.GeoJsonPopup(fields=["location", "hosts", "asns", "hops"],
+                                                         aliases=["Location", "IP", "ASN", "Hops"])).add_to(cluster)
+
+        if lines["features"]:
+            folium.GeoJson(lines, style_function=lambda feature: {"color": "red", "weight": 1.5}).add_to(m)
+
+        if points["features"]:
+            lons, lats = zip(*[e["geometry"]["coordinates"] for e in points["features"]])
+            m.fit_bounds([[min(lats), min(lons)], [max(lats), max(lons)]])
+
+        if geo_config["result"].get("assets"):
+            for element in (m, cluster):
+                element.default_js = [(name, f"{geo_config['result']['assets']}/{url.split('/')[-1]}") for name, url in element.default_js]
+                element.default_css = [(name, f"{geo_config['result']['assets']}/{url.split('/')[-1]}") for name, url in element.default_css]
+
+        m.save(path)
+
+    return path
+
+
+def build_svg(collection: dict, width: int = 1200, height: int = 600) -> str:
+    """
+    This function draws the GeoJSON points and links as the static SVG image in the equirectangular projection,
+    fitted to the area of the points
+    """
+    coordinates = [e["geometry"]["coordinates"] for e in collection["features"] if e["geometry"]["type"] == "Point"]
+    lons, lats = zip(*coordinates) if coordinates else ((-180, 180), (-90, 90))
+
+    # Keeping the aspect ratio of the degrees with 5% padding
+    span = max((max(lons) - min(lons)) / width, (max(lats) - min(lats)) / height, 1e-6) * 1.1
+    clon, clat = (max(lons) + min(lons)) / 2, (max(lats) + min(lats)) / 2
+
+    def xy(lon: float, lat: float) -> str:
+        return f"{round(width / 2 + (lon - clon) / span, 1)},{round(height / 2 - (lat - clat) / span, 1)}"
+
+    result = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">',
+              f'<rect width="{width}" height="{height}" fill="#212121"/>']
+
+    for feature in collection["features"]:
+        if feature["geometry"]["type"] == "MultiLineString":
+            result.extend(f'<polyline points="{xy(*a)} {xy(*b)}" stroke="red" stroke-width="1.5" fill="none"/>'
+                          for a, b in feature["geometry"]["coordinates"])
+
+    for feature in collection["features"]:
+        if feature["geometry"]["type"] == "Point":
+            props = feature["properties"]
+            x, y = xy(*feature["geometry"]["coordinates"]).split(",")
+            result.append(f'<circle cx="{x}" cy="{y}" r="{round(3 + 2 * math.log(props["hops"]), 1)}" fill="#ff4444">'
+                          f'<title>{html.escape(props["location"])}: {html.escape(props["hosts"])} (AS {html.escape(props["asns"])})</title></circle>')
+
+    result.append("</svg>")
+
+    return "\n".join(result)
+
+
+@hs.metrics.timed("enrich", source="isp")
+def augment_isp(mtr_result: dict, geo_config: dict, session=None, cache=None, save: bool = True) -> dict:
+    """
+    This function augments the traceroute with ISP information. Each ASN is looked up once and cached.
+    The cache is written to disk, unless save is False (the caller saves it once for many traces)
     """
     result = mtr_result
 
-    for he in tqdm(result["report"]["hubs"], desc="Collecting ISP information", colour="blue"):
-        url = f"{geo_config['isp']['url']}/net?asn={re.sub('AS', '', he['ASN'])}"
-        response = requests.get(url=url)
+    # Preparing the shared session and cache
+    session = session if session else hs.get_session(pool_size=geo_config["isp"].get("workers", 10))
+    cache = cache if cache else hc.DiskCache(path=f"{get_cache_dir(geo_config)}/isp.json",
+                                             ttl=geo_config["isp"].get("ttl", 604800))
 
-        if response.status_code == 200:
-            try:
-                he.update({"isp": response.json()['data'][0]})
+    # Deduplicating ASNs and skipping the unknown ones (AS???)
+    asns = {get_asn(he) for he in result["report"]["hubs"]}
+    lookup = sorted(asn for asn in asns if asn and asn not in cache)
 
-            except json.decoder.JSONDecodeError as e:
-                he.update({"isp": {}})
+    with concurrent.futures.ThreadPoolExecutor(max_workers=geo_config["isp"].get("workers", 10)) as executor:
+        futures = {executor.submit(get_isp_data, asn, geo_config, session): asn for asn in lookup}
 
-        else:
-            he.update({"isp": {}})
+        for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Collecting ISP information", colour="blue"):
+            isp = future.result()
+            cache.set(futures[future], isp, negative=not isp)
+
+    if save:
+        cache.save()
+
+    for he in result["report"]["hubs"]:
+        he.update({"isp": cache.get(get_asn(he), {}) if get_asn(he) else {}})
 
     return result
 
 
+def get_asn(hop: dict) -> str:
+    """
+    This function returns the ASN number of the hop as string or None, if it is unknown
+    """
+    asn = re.sub("AS", "", hop.get("ASN", ""))
+
+    return asn if asn.isdigit() else None
+
+
+def get_isp_data(asn: str, geo_config: dict, session) -> dict:
+    """
+    This function collects the ISP information for a single ASN
+    """
+    url = f"{geo_config['isp']['url']}/net?asn={asn}"
+
+    try:
+        response = session.get(url=url, timeout=geo_config["isp"].get("timeout", 5))
+
+        if response.status_code == 200:
+            return response.json()["data"][0]
+
+    except (requests.exceptions.RequestException, json.decoder.JSONDecodeError, KeyError, IndexError):
+        hs.metrics.count("http_errors", api="isp")
+
+    return {}
+
+
 def build_isp(target: str, mtr_result: dict, geo_config: dict) -> None:
     """
     This function builds the map of the trace
     """
-    groups = ["You"]
+    build_topology(traces=[mtr_result], geo_config=geo_config, heading=f"Traceroute to {target[0]} over {target[1]}")
+
 
+@hs.metrics.timed("render", output="topology")
+def build_topology(traces: list, geo_config: dict, heading: str) -> None:
+    """
+    This function builds the merged topology of the traces. Repeated hops are collapsed into shared nodes
+    with aggregated loss and latency on the edges. If there are too many nodes, they are clustered per ASN
+    """
     failure_colors = [
         "#ffffff",
         "#ffeeee",
@@ -136,62 +544,242 @@ def build_isp(target: str, mtr_result: dict, geo_config: dict) -> None:
         "#ff0000"
     ]
 
+    # Local vars
+    groups = {"You": 0}
+    nodes = {}
+    edges = {}
+
     print("Compiling the trace...")
 
-    nt = Network(height="600px", width="1200px", directed=True, bgcolor="#212121", font_color="#ffffff", 
-                 layout=True, heading=f"Traceroute to {target[0]} over {target[1]}")
-    
-    nt.add_node(0, label=mtr_result["report"]["mtr"]["src"], title="You", level=0)
+    hosts = {he["host"] for tr in traces for he in tr["report"]["hubs"]}
+    cluster = len(hosts) > geo_config["result"].get("max_nodes", 1000)
 
-    for he in mtr_result["report"]["hubs"]:
-        isp_name = he["isp"]["name"] if he["isp"] else "Unknown ISP"
-        asn = int(re.sub('AS', '', he['ASN']))
-        title = f"ISP: {isp_name}<br>ASN: {asn}<br>IP: {he['host']}"
-        
-        if asn not in groups:
-            groups.append(he["isp"]["asn"])
-            group = len(groups) - 1
+    for index, tr in enumerate(traces):
+        prev = tr["report"]["mtr"]["src"]
+        nodes.setdefault(prev, {"label": prev, "title": "You", "level": 0, "hits": 0})
+        nodes[prev]["hits"] += 1
 
-        else:
-            i = 0
-            while he["isp"]["asn"] != groups[i]:
-                i += 1
+        for he in tr["report"]["hubs"]:
+            asn = get_asn(he)
+            group = groups.setdefault(asn, len(groups))
 
-            group = i
+            # Unanswered hops are never merged across traces
+            if cluster:
+                key = f"AS{asn}" if asn else "AS???"
 
-        for i, fc in enumerate(failure_colors):
-            if he["Loss%"] == float(i * 10):
-                lc = fc
             else:
-                if he["Loss%"] > float(i * 10) and he["Loss%"] < float((i + 1) * 10):
-                    lc = failure_colors[i + 1]
-                
-        nt.add_node(int(he["count"]), label=he["host"], title=title, level=group)
-        nt.add_edge(int(he["count"]) - 1, int(he["count"]), title=f"Loss: {he['Loss%']}%<br>Latency: {he['Avg']} ms", color=lc, weight=1.5)
+                key = he["host"] if he["host"] != "???" else f"???-{index}-{he['count']}"
+
+            if key not in nodes:
+                isp_name = he["isp"]["name"] if he.get("isp") else "Unknown ISP"
+                title = f"ISP: {isp_name}<br>ASN: {asn if asn else 'Unknown'}"
+
+                nodes[key] = {"label": key if cluster else he["host"], "level": group, "hits": 0,
+                              "title": title if cluster else f"{title}<br>IP: {he['host']}"}
+
+            nodes[key]["hits"] += 1
+
+            # Hops within the same cluster are not linked to themselves
+            if key != prev:
+                edge = edges.setdefault((prev, key), {"loss": 0.0, "latency": 0.0, "count": 0})
+                edge["loss"] += he["Loss%"]
+                edge["latency"] += he["Avg"]
+                edge["count"] += 1
+
+            prev = key
+
+    nt = pyvis_network.Network(height="600px", width="1200px", directed=True, bgcolor="#212121", font_color="#ffffff",
+                 layout=True, heading=heading)
+
+    for key, node in nodes.items():
+        nt.add_node(key, label=node["label"], title=f"{node['title']}<br>Seen: {node['hits']}", level=node["level"])
+
+    for (src, dst), edge in edges.items():
+        loss = edge["loss"] / edge["count"]
+        lc = failure_colors[min(len(failure_colors) - 1, math.ceil(loss / 10))]
+
+        nt.add_edge(src, dst, title=f"Loss: {round(loss, 1)}%<br>Latency: {round(edge['latency'] / edge['count'], 2)} ms<br>Traces: {edge['count']}",
+                    color=lc, weight=1.5)
+
+    nt.write_html(geo_config["result"]["file_asn"])
+
+
+def load_targets(path: str) -> list:
+    """
+    This function reads the destinations from the file skipping empty lines and comments
+    """
+    try:
+        with open(path, "r") as f:
+            return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+    except FileNotFoundError:
+        sys.exit(f"The targets file {path} cannot be found.")
 
-    nt.show(geo_config["result"]["file_asn"])
+
+def trace_target(target: str, target_type: str) -> dict:
+    """
+    This function traces a single destination and keeps the error instead of stopping the batch
+    """
+    try:
+        return {"target": target, "type": target_type, "result": get_path(target, target_type)}
+
+    except SystemExit as e:
+        return {"target": target, "type": target_type, "error": str(e)}
+
+
+def trace_batch(targets: list, target_type: str, geo_config: dict, workers: int = 10,
+                session=None, geo_cache=None, isp_cache=None, on_trace=None) -> list:
+    """
+    This function traces many destinations concurrently. Each trace is augmented and passed to on_trace
+    as soon as it completes, while the others are still running. The session and caches are shared,
+    so a hop seen in many paths is enriched only once
+    """
+    result = {}
+
+    if "geo" in geo_config:
+        session = session if session else hs.get_session(pool_size=geo_config["geo"].get("workers", 10))
+        geo_cache = geo_cache if geo_cache else hc.DiskCache(path=f"{get_cache_dir(geo_config)}/geo.json",
+                                                             ttl=geo_config["geo"].get("ttl", 86400))
+
+    if "isp" in geo_config:
+        session = session if session else hs.get_session(pool_size=geo_config["isp"].get("workers", 10))
+        isp_cache = isp_cache if isp_cache else hc.DiskCache(path=f"{get_cache_dir(geo_config)}/isp.json",
+                                                             ttl=geo_config["isp"].get("ttl", 604800))
+
+    # The caches are written to disk once per batch rather than per trace
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(trace_target, target, target_type): target for target in targets}
+
+            for future in concurrent.futures.as_completed(futures):
+                entry = future.result()
+
+                if "result" in entry and "geo" in geo_config:
+                    augment_geo_data(entry["result"], geo_config, session=session, cache=geo_cache, save=False)
+
+                if "result" in entry and "isp" in geo_config:
+                    augment_isp(entry["result"], geo_config, session=session, cache=isp_cache, save=False)
+
+                if on_trace:
+                    on_trace(entry)
+
+                result[futures[future]] = entry
+
+    finally:
+        for cache in [geo_cache, isp_cache]:
+            if cache:
+                cache.save()
+
+    return [result[target] for target in targets if target in result]
+
+
+def trace_rows(entry: dict):
+    """
+    This function yields the hops of the trace as the flat rows for CSV
+    """
+    for he in entry.get("result", {}).get("report", {}).get("hubs", []):
+        yield {"target": entry["target"], "type": entry["type"], "hop": he["count"], "host": he["host"], "asn": he.get("ASN"),
+               "loss": he.get("Loss%"), "sent": he.get("Snt"), "last": he.get("Last"), "avg": he.get("Avg"), "best": he.get("Best"),
+               "worst": he.get("Wrst"), "stdev": he.get("StDev"), "city": (he.get("geo") or {}).get("city"),
+               "country": (he.get("geo") or {}).get("country_name"), "isp": (he.get("isp") or {}).get("name")}
+
+    if "error" in entry:
+        yield {"target": entry["target"], "type": entry["type"], "error": entry["error"]}
+
+
+@hs.metrics.timed("baseline")
+def check_baseline(traces: list, geo_config: dict) -> list:
+    """
+    This function checks each trace against the per-hop baseline and adds it to the baseline.
+    The baseline is kept per destination and address family
+    """
+    result = []
+    conn = hb.open_baseline(f"{get_cache_dir(geo_config)}/baseline.sqlite")
+
+    try:
+        for entry in traces:
+            if "result" in entry:
+                entry["anomalies"] = hb.check_trace(conn, f"{entry['target']}/{entry['type']}", entry["result"]["report"]["hubs"],
+                                                    geo_config.get("baseline"))
+                result.extend(entry["anomalies"])
+
+    finally:
+        conn.close()
+
+    return result
+
+
+def print_anomalies(anomalies: list) -> None:
+    """
+    This function prints the anomalies found in the traces
+    """
+    for entry in anomalies:
+        if entry["anomaly"] == "path_changed":
+            print(f"{entry['dst']}: path changed from {' > '.join(entry['old_path'])} to {' > '.join(entry['new_path'])}")
+
+        elif entry["anomaly"] == "latency":
+            print(f"{entry['dst']}: hop {entry['hop']} ({entry['host']}) latency {entry['avg']} ms is above {entry['threshold']} ms")
+
+        else:
+            print(f"{entry['dst']}: hop {entry['hop']} ({entry['host']}) loss {entry['loss']}% over the baseline of {entry['baseline']['ewma_loss']}%")
 
 
 # Body
 if __name__ == "__main__":
     # Getting config
-    try:
-        config = yaml.load(open(config_file, "r").read(), Loader=yaml.Loader)
+    config = hs.import_config(config_file)
+
+    # Getting arguments
+    args = args_parser()
+
+    if args.mode == "batch":
+        writer = ho.open_writer(args, fields=["target", "type", "hop", "host", "asn", "loss", "sent", "last", "avg", "best",
+                                              "worst", "stdev", "city", "country", "isp", "error"] if args.format == "csv" else None)
+
+        # Each trace is written as soon as it is completed
+        def on_trace(entry: dict) -> None:
+            if args.baseline:
+                print_anomalies(check_baseline([entry], config))
+
+            for record in trace_rows(entry) if args.format == "csv" else [entry]:
+                writer.write(record)
 
-    except:
-        sys.exit(f"Can't open the cofniguration file {config_file}.")
+        with contextlib.redirect_stdout(sys.stderr) if args.output == "-" else contextlib.nullcontext():
+            traces = trace_batch(load_targets(args.targets), args.family, config, args.workers, on_trace=on_trace)
+            writer.close()
+
+        if args.map and "geo" in config:
+            print(f"Map: {render_map([e['result'] for e in traces if 'result' in e], config, fmt=args.map_format if args.map_format not in {'', 'html'} else 'compact')}")
+
+        if args.graph:
+            build_topology(traces=[e["result"] for e in traces if "result" in e], geo_config=config,
+                           heading=f"Traceroutes to {len(traces)} destinations over {args.family}")
+
+        print(f"Traced {len(traces)} destinations, {len([e for e in traces if 'error' in e])} failed. Results: {', '.join(writer.files) if writer.files else 'stdout'}",
+              file=sys.stderr if args.output == "-" else sys.stdout)
+        sys.exit()
+
+    # Geting hops, in the stream mode the Geo data is collected while the trace is running
+    if args.stream and args.mode == "map":
+        session = hs.get_session(pool_size=config["geo"].get("workers", 10))
+        geo_cache = hc.DiskCache(path=f"{get_cache_dir(config)}/geo.json", ttl=config["geo"].get("ttl", 86400))
+        traceroute = get_path_stream(*destination, geo_config=config, session=session, cache=geo_cache)
+
+    else:
+        session, geo_cache = None, None
+        traceroute = get_path_stream(*destination) if args.stream else get_path(*destination)
 
-    # Geting hops
-    traceroute = get_path(*destination)
+    if args.baseline:
+        print_anomalies(check_baseline([{"target": destination[0], "type": destination[1], "result": traceroute}], config))
 
-    if len(sys.argv) < 2 or sys.argv[1] == "map":    
+    if args.mode == "map":
         # Getting geo data
-        traceroute = augment_geo_data(traceroute, config)
+        traceroute = augment_geo_data(traceroute, config, session=session, cache=geo_cache)
 
         # Build map
-        build_map(traceroute, config)
+        build_map(traceroute, config, fmt=args.map_format)
 
-    if len(sys.argv) > 1 and sys.argv[1] == "isp":
+    if args.mode == "isp":
         # Getting ISP names
         traceroute = augment_isp(traceroute, config)
 